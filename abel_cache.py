@@ -0,0 +1,103 @@
+""" This file defines the MatrixCache class, an on-disk cache of the transformation
+matrices precalculated by Abel_object (abel_davis_class.py), so that they are not
+recomputed when the GUI is restarted or when going back to a geometry already used.
+
+The matrices only depend on the radial grid (N_R, dr) and on d_alpha, so they are
+stored in one directory per geometry, named by a hash of these parameters and of
+CACHE_VERSION (to be incremented when the stored matrices change meaning). Each
+matrix is a .npy file which is opened memory-mapped, so loading is instantaneous
+and only the pages actually used are read. When the cache is larger than max_bytes
+the least recently used geometries are removed.
+"""
+
+import os
+import shutil
+import hashlib
+import numpy as np
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pco_edge', 'abel_cache')
+
+
+class MatrixCache(object):
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=4e9):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, N_R, dr, d_alpha):
+        """ name of the directory for this geometry"""
+        params = repr((CACHE_VERSION, int(N_R), float(dr), float(d_alpha)))
+        return hashlib.sha1(params.encode()).hexdigest()[:16]
+
+    def _dir(self, key):
+        return os.path.join(self.path, key)
+
+    def load(self, key, name):
+        """ memory-mapped matrix, or None if it is not in the cache"""
+        filename = os.path.join(self._dir(key), name + '.npy')
+        try:
+            matrix = np.load(filename, mmap_mode='r')
+        except (OSError, ValueError):  # missing or incomplete file
+            return None
+        os.utime(self._dir(key))  # most recently used
+        return matrix
+
+    def save(self, key, name, matrix, description=''):
+        """ stores matrix (written in a temporary file first so that a file in the
+        cache is always complete), then removes old geometries if needed"""
+        directory = self._dir(key)
+        os.makedirs(directory, exist_ok=True)
+        if description and not os.path.exists(os.path.join(directory, 'geometry.txt')):
+            with open(os.path.join(directory, 'geometry.txt'), 'w') as f:
+                f.write(description + '\n')
+        filename = os.path.join(directory, name + '.npy')
+        np.save(filename + '.tmp.npy', matrix)
+        os.replace(filename + '.tmp.npy', filename)
+        os.utime(directory)
+        self.evict(keep=key)
+
+    def size(self, key):
+        """ bytes used by a geometry. The temporary files of a save in progress are
+        not counted, and a file removed while listing (replaced by a save) is ignored"""
+        directory = self._dir(key)
+        total = 0
+        try:
+            names = os.listdir(directory)
+        except OSError:  # the directory was removed
+            return 0
+        for name in names:
+            if name.endswith('.tmp.npy'):
+                continue
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+        return total
+
+    def _mtime(self, key):
+        try:
+            return os.path.getmtime(self._dir(key))
+        except OSError:  # removed meanwhile, sorted first
+            return 0.
+
+    def evict(self, keep=None):
+        """ removes the least recently used geometries until the cache holds at most
+        max_bytes (the geometry keep is never removed)"""
+        keys = [k for k in os.listdir(self.path) if os.path.isdir(self._dir(k))]
+        sizes = {k: self.size(k) for k in keys}
+        total = sum(sizes.values())
+        for k in sorted(keys, key=self._mtime):
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            try:
+                shutil.rmtree(self._dir(k))
+                total -= sizes[k]
+            except OSError:  # still opened (memory-mapped) on Windows
+                pass
+
+    def clear(self):
+        for k in os.listdir(self.path):
+            shutil.rmtree(self._dir(k), ignore_errors=True)
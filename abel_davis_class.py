@@ -1,12 +1,152 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from abel.tools import polar
+from scipy import sparse
 from scipy.special import eval_legendre, hyp2f1
+from scipy.linalg import solve_triangular
+from scipy.linalg.lapack import dtbtrs, dtrcon
 from math import factorial
 from time import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+
+
+class PolarPlan():
+    def __init__(self, shape, origin, dr, d_alpha, N_R=None, use_sparse=True):
+        """
+            Precomputed reprojection of images of a given shape into polar coordinates,
+            with bilinear interpolation and the Jacobian (r) included. The polar grid is
+            the one of abel.tools.polar.reproject_image_into_polar (angle measured from
+            the upward direction, radii i * dr) so that it can replace it for repeated frames: the
+            source pixel indices and weights are computed once, and each frame costs a
+            single sparse matrix product (or one gather and one weighted sum).
+
+            Parameters
+            ----------
+            shape : (Ny, Nx)
+                shape of the images
+            origin : (row, column)
+                coordinates of the pole
+            dr : float
+                radial coordinate spacing
+            d_alpha : float
+                angular coordinate spacing (in radians)
+            N_R : int or None
+                number of radii to compute (the first N_R of the full polar grid)
+            use_sparse : bool
+                apply the plan as a scipy.sparse matrix (otherwise with np.take)
+        """
+        self.shape = tuple(shape)
+        self.origin = origin
+        ny, nx = self.shape
+
+        # same extent of the polar grid as reproject_image_into_polar
+        x, y = np.meshgrid(np.arange(float(nx)) - origin[1], origin[0] - np.arange(float(ny)))
+        r, theta = np.sqrt(x**2 + y**2), np.arctan2(x, y)
+        nr = int(np.ceil(r.max() / dr))
+        nt = int(np.ceil((theta.max() - theta.min()) / d_alpha))
+        # the radii are anchored at r = 0 (like R_vector and the matrices), also for a
+        # center between pixels where r.min() is not 0
+        self.r_vector = (np.arange(nr) * dr)[:N_R]
+        self.theta_vector = np.linspace(theta.min(), theta.max(), nt, endpoint=False)
+        self.polar_shape = (len(self.r_vector), nt)
+        del x, y, r, theta
+
+        theta_grid, r_grid = np.meshgrid(self.theta_vector, self.r_vector)
+        rows = (origin[0] - r_grid * np.cos(theta_grid)).ravel()
+        cols = (origin[1] + r_grid * np.sin(theta_grid)).ravel()
+        # points outside the image are 0, like with map_coordinates (mode='constant')
+        jacobian = r_grid.ravel() * ((rows >= 0) & (rows <= ny - 1) & (cols >= 0) & (cols <= nx - 1))
+
+        # the 4 neighbours of each point and their bilinear weights (0 outside the image)
+        r0, c0 = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+        fr, fc = rows - r0, cols - c0
+        self.indices = np.empty((4, rows.size), dtype=np.int64)
+        self.weights = np.empty((4, rows.size))
+        for j, (dr_, dc_, w) in enumerate([(0, 0, (1 - fr) * (1 - fc)), (0, 1, (1 - fr) * fc),
+                                           (1, 0, fr * (1 - fc)), (1, 1, fr * fc)]):
+            rr, cc = r0 + dr_, c0 + dc_
+            inside = (rr >= 0) & (rr < ny) & (cc >= 0) & (cc < nx)
+            self.indices[j] = np.where(inside, rr * nx + cc, 0)
+            self.weights[j] = np.where(inside, w * jacobian, 0)
+
+        self.use_sparse = use_sparse
+        if use_sparse:
+            points = np.tile(np.arange(rows.size), 4)
+            self.matrix = sparse.csr_matrix((self.weights.ravel(), (points, self.indices.ravel())),
+                                            shape=(rows.size, ny * nx))
+            del self.indices, self.weights
+        else:
+            self._values = np.empty(self.weights.shape)
+            self._gathered = None  # pixel values, in the dtype of the data
+
+    def apply(self, data, out=None):
+        """ polar image (with the Jacobian) of data, written in out if given"""
+        if data.shape != self.shape:
+            raise ValueError('Incorrect data shape')
+        if out is None:
+            out = np.empty(self.polar_shape)
+        if self.use_sparse:
+            out.ravel()[:] = self.matrix.dot(data.ravel())
+        else:
+            if self._gathered is None or self._gathered.dtype != data.dtype:
+                self._gathered = np.empty(self.weights.shape, dtype=data.dtype)
+            np.take(data.ravel(), self.indices, out=self._gathered)
+            np.multiply(self._gathered, self.weights, out=self._values)
+            self._values.sum(axis=0, out=out.ravel())
+        return out
+
+    def apply_stack(self, frames):
+        """ polar images of a (n_frames, Ny, Nx) array, returned as
+        (N_r * N_theta, n_frames)"""
+        flat = frames.reshape(frames.shape[0], -1)
+        if self.use_sparse:
+            return np.asarray(self.matrix.dot(flat.T))
+        return (flat[:, self.indices] * self.weights).sum(axis=1).T
+
+
+class BandedTriangular():
+    def __init__(self, ab):
+        """
+            Upper triangular matrix with a limited number of superdiagonals (bandwidth),
+            stored in the LAPACK banded layout ab[bandwidth + i - j, j] = M[i, j].
+            It uses (bandwidth + 1) * n values instead of n * n and its triangular
+            solve costs O(n * bandwidth) instead of O(n^2).
+        """
+        self.ab = np.asfortranarray(ab)  # layout expected by LAPACK, avoids a copy per solve
+        self.bandwidth = ab.shape[0] - 1
+        self.shape = (ab.shape[1], ab.shape[1])
+
+    @classmethod
+    def from_dense(cls, matrix, bandwidth):
+        """ band of the upper triangular matrix, the elements beyond are dropped"""
+        n = matrix.shape[0]
+        ab = np.zeros((bandwidth + 1, n), order='F')
+        for d in range(bandwidth + 1):  # d-th superdiagonal
+            ab[bandwidth - d, d:] = np.diagonal(matrix, d)
+        return cls(ab)
+
+    @property
+    def nbytes(self):
+        return self.ab.nbytes
+
+    def solve(self, b):
+        """ x such that M x = b, b of shape (n,) or (n, n_rhs)"""
+        x, info = dtbtrs(self.ab, b.reshape(b.shape[0], -1), uplo='U')
+        if info != 0:
+            raise np.linalg.LinAlgError('singular banded matrix')
+        return x.reshape(b.shape)
+
+    def toarray(self):
+        M = np.zeros(self.shape)
+        for d in range(self.bandwidth + 1):
+            i = np.arange(self.shape[0] - d)
+            M[i, i + d] = self.ab[self.bandwidth - d, d:]
+        return M
+
 
 class Abel_object():
-    def __init__(self, data, center_x, center_y, d_alpha_deg, dr, N, parent=None):
+    def __init__(self, data, center_x, center_y, d_alpha_deg, dr, N, parent=None, cache=None,
+                 R_max=None):
         """
             Creates an object that can Abel invert an image using the DAVIS
             (Direct Algorithm for Velocity-map Imaging) technique described in
@@ -29,6 +169,17 @@ class Abel_object():
                 number of photons. Determines the number of legendre polynomials
                 to use (which is equal to 2N+1)
                 ex: if N=1 then P0, P1 and P2 are used, if N=2 then P0 to P4 are used.
+            parent : CameraWidget or None
+                the widget using this object (the progress of the precalculation
+                is reported through the progress argument of precalculate)
+            cache : abel_cache.MatrixCache or None
+                on-disk cache of the matrices. The matrices already in the cache
+                are loaded (memory-mapped) here, and precalculate only computes
+                (and stores) the missing ones.
+            R_max : float or None
+                maximum radius of the inversion (in pixels), None: up to the nearest
+                edge of the image. The size of the matrices and the cost of the
+                inversion scale as (R_max/dr)^2.
         """
 
         self.parent = parent
@@ -43,23 +194,58 @@ class Abel_object():
 
         self.N_alpha = int(2 * np.pi / self.d_alpha)
         self.N_R = int(min((self.Ny - center_y) / dr, (self.Nx - center_x) / dr))
+        if R_max is not None:
+            self.N_R = max(1, min(self.N_R, int(R_max / dr)))
 
         self.R_vector = np.linspace(dr, self.N_R * dr, self.N_R)
         self.alpha_vector = np.linspace(2 * np.pi / self.N_alpha, 2 * np.pi, self.N_alpha)
 
-        self.data_polar, r_grid, theta_grid = polar.reproject_image_into_polar(
-            data, origin=(center_x, center_y), dr=dr, dt=self.d_alpha, Jacobian=True)
+        # the polar reprojection is prepared once and reused by set_data
+        self.plan = PolarPlan(data.shape, (center_x, center_y), dr, self.d_alpha, N_R=self.N_R)
+        self.data_polar = self.plan.apply(data)
 
-        self.M_inv = {}
+        self.W = self.legendre_weights()
+        self.Mkk = {}  # upper triangular M_kk, used with back-substitution (no explicit inverse)
         self.Mnk = {}
+        self.truncation = {}  # see truncate
         self.F = {}
+        self.delta_sum = None  # running sum of the Legendre projections, see accumulate
+        self.n_accumulated = 0
+
+        self.cache = cache
+        if cache is not None:
+            self.cache_key = cache.key(self.N_R, self.dr, self.d_alpha)
+            self.load_from_cache()
 
     def set_data(self, data):
         if data.shape != (self.Ny, self.Nx):
             print('Incorrect data shape')
             raise ValueError
-        self.data_polar, r_grid, theta_grid = polar.reproject_image_into_polar(
-            data, origin=(self.center_x, self.center_y), dr=self.dr, dt=self.d_alpha, Jacobian=True)
+        self.plan.apply(data, out=self.data_polar)
+
+    def set_center(self, center_x, center_y, tol=0.):
+        ''' Moves the center of the inversion. The matrices only depend on the radial
+        grid (N_R, dr) and on d_alpha, so only the polar plan is rebuilt (a few
+        seconds instead of the precalculation), and nothing is done if the center
+        moves by at most tol pixels (in x and y). N_R is kept: if the center gets
+        closer to an edge, the points of the largest radii outside the image are 0.
+        Returns True if the plan was rebuilt. '''
+        if max(abs(center_x - self.center_x), abs(center_y - self.center_y)) <= tol:
+            return False
+        self.plan = PolarPlan((self.Ny, self.Nx), (center_x, center_y), self.dr, self.d_alpha,
+                              N_R=self.N_R)
+        self.data_polar = np.zeros(self.plan.polar_shape)
+        self.center_x = center_x
+        self.center_y = center_y
+        return True
+
+    def set_polar_data(self, data_polar):
+        ''' sets data_polar directly, e.g. from a centroiding.HitHistogram binned on
+        the polar grid of self.plan (no reprojection) '''
+        if data_polar.shape != self.data_polar.shape:
+            print('Incorrect polar data shape')
+            raise ValueError
+        self.data_polar[...] = data_polar
 
     def show(self, data):
         plt.figure()
@@ -124,126 +310,348 @@ class Abel_object():
     def M(self,N_R,n,k):
         ''' This function calculates the upper triangular transformation matrices Mn,n-2k using the analytical formulas
         from Table I. I checked that it's equal to M_eqn13(N_R,n,k). However it's faster than M_eq13 so this is the function
-        actually used '''
+        actually used. All the elements (i <= ip) are computed at once with numpy arrays '''
         d_alpha = self.d_alpha
         dr = self.dr
+        i, ip = np.triu_indices(N_R)
+        R_i = self.R_vector[i]
+        R_ip = self.R_vector[ip] # ri'
+        R_plus = np.where(ip == i, R_i, R_i + dr/2) # Ri ^ = Ri + DeltaR/2 (Ri on the diagonal)
+        R_minus = R_i - dr/2 # Ri v = Ri - DeltaR/2
+        D_plus = R_ip**2 - R_plus**2
+        D_minus = R_ip**2 - R_minus**2
+        S_plus, S_minus = np.sqrt(D_plus), np.sqrt(D_minus)
+        P_plus, P_minus = D_plus**(3/2), D_minus**(3/2)
+
+        if(n==0 and k==0): # M00
+            values = 2*dr*d_alpha/R_ip*(S_minus-S_plus)
+        elif(n==1 and k==0): # M11
+            values = dr*d_alpha/R_ip**2*\
+                     (R_minus*S_minus-R_plus*S_plus+\
+                      R_ip**2*np.arcsin(R_plus/R_ip)-R_ip**2*np.arcsin(R_minus/R_ip))
+        elif(n==2 and k==0): # M22
+            values = 2*dr*d_alpha/(3*R_ip**3)*\
+                     (S_minus*(2*R_ip**2+R_minus**2)-\
+                      S_plus*(2*R_ip**2+R_plus**2))
+        elif(n==2 and k==1): # M20
+            values = dr*d_alpha/(3*R_ip**3)*(P_plus-P_minus)
+        elif(n==3 and k==0): # M33
+            values = dr*d_alpha/(4*R_ip**4)*\
+                     (R_minus*S_minus*(3*R_ip**2+2*R_minus**2)-\
+                      R_plus*S_plus*(3*R_ip**2+2*R_plus**2)+\
+                      3*R_ip**4*np.arcsin(R_plus/R_ip) - 3*R_ip**4*np.arcsin(R_minus/R_ip))
+        elif(n==3 and k==1): # M31
+            values = 3*dr*d_alpha/(8*R_ip**4)*\
+                     (R_minus*S_minus*((-1)*R_ip**2+2*R_minus**2)-\
+                      R_plus*S_plus*((-1)*R_ip**2+2*R_plus**2)+\
+                      R_ip**4*np.arcsin(R_minus/R_ip) - R_ip**4*np.arcsin(R_plus/R_ip))
+        elif(n==4 and k==0): # M44
+            values = 2*dr*d_alpha/(15*R_ip**5)*\
+                     (S_minus*(8*R_ip**4+4*R_ip**2*R_minus**2+3*R_minus**4)- \
+                      S_plus*(8*R_ip**4+4*R_ip**2*R_plus**2+3*R_plus**4))
+        elif(n==4 and k==1): # M42
+            values = dr*d_alpha/(3*R_ip**5)*\
+                     (P_plus*(2*R_ip**2+3*R_plus**2)- \
+                      P_minus*(2*R_ip**2+3*R_minus**2))
+        elif(n==4 and k==2): # M40
+            values = dr*d_alpha/(60*R_ip**5)*\
+                     (P_plus*((19)*R_ip**2+51*R_plus**2)- \
+                      P_minus*((19)*R_ip**2+51*R_minus**2))
+            # there is possibly an error in the paper (for M40).
+            # This corrected formula gives the same thing as M_eq13
+        elif(n==6 and k==2): # M62 (not in the article)
+            values = dr*d_alpha/(84*R_ip**7)*\
+                     (P_plus*(975*R_plus**4+633*R_plus**2*R_ip**2+422*R_ip**4)- \
+                      P_minus*(975*R_minus**4+633*R_minus**2*R_ip**2+422*R_ip**4))
+        elif(n==6 and k==3): # M60 (not in the article)
+            values = dr*d_alpha/(1680*R_ip**7)*\
+                     (P_plus*(2670*R_plus**4-1329*R_plus**2*R_ip**2-536*R_ip**4)- \
+                      P_minus*(2670*R_minus**4-1329*R_minus**2*R_ip**2-536*R_ip**4))
+        else: # not implemented, same as before: zero matrix
+            values = 0
         M = np.zeros((N_R,N_R))
-        for i in range (0, N_R):
-            for ip in range(i, N_R):
-                if ip == i:
-                    R_plus = self.R_vector[i]
-                else:
-                    R_plus = self.R_vector[i] + dr/2 # Ri ^ = Ri + DeltaR/2
-                R_minus = self.R_vector[i] - dr/2 # Ri v = Ri - DeltaR/2
-                R_ip = self.R_vector[ip] # ri'
-
-                if(n==0 and k==0): # M00
-                    M[i,ip] = 2*dr*d_alpha/R_ip*(np.sqrt(R_ip**2-R_minus**2)-np.sqrt(R_ip**2-R_plus**2))
-                elif(n==1 and k==0): # M11
-                    M[i,ip] = dr*d_alpha/R_ip**2*\
-                              (R_minus*np.sqrt(R_ip**2-R_minus**2)-R_plus*np.sqrt(R_ip**2-R_plus**2)+\
-                               R_ip**2*np.arcsin(R_plus/R_ip)-R_ip**2*np.arcsin(R_minus/R_ip))
-                elif(n==2 and k==0): # M22
-                    M[i,ip] = 2*dr*d_alpha/(3*R_ip**3)*\
-                              (np.sqrt(R_ip**2-R_minus**2)*(2*R_ip**2+R_minus**2)-\
-                               np.sqrt(R_ip**2-R_plus**2)*(2*R_ip**2+R_plus**2))
-                elif(n==2 and k==1): # M20
-                    M[i,ip] = dr*d_alpha/(3*R_ip**3)*((R_ip**2-R_plus**2)**(3/2)-(R_ip**2-R_minus**2)**(3/2))
-                elif(n==3 and k==0): # M33
-                    M[i,ip] = dr*d_alpha/(4*R_ip**4)*\
-                              (R_minus*np.sqrt(R_ip**2-R_minus**2)*(3*R_ip**2+2*R_minus**2)-\
-                               R_plus*np.sqrt(R_ip**2-R_plus**2)*(3*R_ip**2+2*R_plus**2)+\
-                               3*R_ip**4*np.arcsin(R_plus/R_ip) - 3*R_ip**4*np.arcsin(R_minus/R_ip))
-                elif(n==3 and k==1): # M31
-                    M[i,ip] = 3*dr*d_alpha/(8*R_ip**4)*\
-                              (R_minus*np.sqrt(R_ip**2-R_minus**2)*((-1)*R_ip**2+2*R_minus**2)-\
-                               R_plus*np.sqrt(R_ip**2-R_plus**2)*((-1)*R_ip**2+2*R_plus**2)+\
-                               R_ip**4*np.arcsin(R_minus/R_ip) - R_ip**4*np.arcsin(R_plus/R_ip))
-                elif(n==4 and k==0): # M44
-                    M[i,ip] = 2*dr*d_alpha/(15*R_ip**5)*\
-                              (np.sqrt(R_ip**2-R_minus**2)*(8*R_ip**4+4*R_ip**2*R_minus**2+3*R_minus**4)- \
-                               np.sqrt(R_ip**2-R_plus**2)*(8*R_ip**4+4*R_ip**2*R_plus**2+3*R_plus**4))
-                elif(n==4 and k==1): # M42
-                    M[i,ip] = dr*d_alpha/(3*R_ip**5)*\
-                              ((R_ip**2-R_plus**2)**(3/2)*(2*R_ip**2+3*R_plus**2)- \
-                               (R_ip**2-R_minus**2)**(3/2)*(2*R_ip**2+3*R_minus**2))
-                elif(n==4 and k==2): # M40
-                    M[i,ip] = dr*d_alpha/(60*R_ip**5)*\
-                              ((R_ip**2-R_plus**2)**(3/2)*((19)*R_ip**2+51*R_plus**2)- \
-                               (R_ip**2-R_minus**2)**(3/2)*((19)*R_ip**2+51*R_minus**2))
-                    # there is possibly an error in the paper (for M40).
-                    # This corrected formula gives the same thing as M_eq13
-                elif(n==6 and k==2): # M62 (not in the article)
-                    M[i,ip] = dr*d_alpha/(84*R_ip**7)*\
-                              ((R_ip**2-R_plus**2)**(3/2)*(975*R_plus**4+633*R_plus**2*R_ip**2+422*R_ip**4)- \
-                               (R_ip**2-R_minus**2)**(3/2)*(975*R_minus**4+633*R_minus**2*R_ip**2+422*R_ip**4))
-                elif(n==6 and k==3): # M60 (not in the article)
-                    M[i,ip] = dr*d_alpha/(1680*R_ip**7)*\
-                              ((R_ip**2-R_plus**2)**(3/2)*(2670*R_plus**4-1329*R_plus**2*R_ip**2-536*R_ip**4)- \
-                               (R_ip**2-R_minus**2)**(3/2)*(2670*R_minus**4-1329*R_minus**2*R_ip**2-536*R_ip**4))
+        M[i, ip] = values
         return M
 
-    def precalculate(self):
+    def required_matrices(self):
+        ''' keys of the matrices used by invert: k for Mkk[k] = M(N_R, k, 0) and
+        (n, i) for Mnk[(n, i)] = M(N_R, n, i), with n = k+2i <= 2N '''
         N = self.N
-        print('precalculating matrices...')
-        for k in range(0, 2 * N + 1):
-            self.M_inv[k] = np.linalg.inv(self.M(self.N_R,k,0))  # inverse of M_kk
-            try:
-                self.parent.progress_precalc.setValue(int((k+1)/(2*N+1)*50))
-                self.parent.progress_precalc.repaint()
-            except AttributeError:
-                print(int((k+1)/(2*N+1)*50), " %")
-
-        for k in range(2 * N, -1, -1):  # reversed loop from 2N to 0 included
-            if k % 2 == 0:  # even k
-                if k == 2 * N:  # no sum over i
-                    pass
-                elif k == 2 * N - 2:  # only one term in the sum
-                    i = 1
-                    self.Mnk[(k + 2 * i, i)] = self.M(self.N_R, k+2*i, i)
-                else:
-                    for i in range(1, N - k // 2 + 1):
-                        self.Mnk[(k + 2 * i, i)] = self.M(self.N_R,k+2*i,i)
-            elif k % 2 == 1:  # odd k
-                for i in range(1, N - (int(k / 2) + 1) + 1):
-                    self.Mnk[(k + 2 * i, i)] = self.M(self.N_R,k+2*i,i)
-            try:
-                self.parent.progress_precalc.setValue(int((2*N+1-k)/(2*N+1)*50+50))
-                self.parent.progress_precalc.repaint()
-            except AttributeError:
-                print(int((2*N+1-k)/(2*N+1)*50+50), " %")
+        Mkk_keys = list(range(0, 2 * N + 1))
+        Mnk_keys = [(k + 2 * i, i) for k in range(2 * N, -1, -1)
+                    for i in range(1, (2 * N - k) // 2 + 1)]
+        return Mkk_keys, Mnk_keys
+
+    def load_from_cache(self):
+        ''' loads the matrices available in the cache, returns True if all
+        the matrices needed for N are there '''
+        Mkk_keys, Mnk_keys = self.required_matrices()
+        for k in Mkk_keys:
+            if k not in self.Mkk:
+                matrix = self.cache.load(self.cache_key, 'M_%d_0' % k)
+                if matrix is not None:
+                    self.Mkk[k] = matrix
+        for key in Mnk_keys:
+            if key not in self.Mnk:
+                matrix = self.cache.load(self.cache_key, 'M_%d_%d' % key)
+                if matrix is not None:
+                    self.Mnk[key] = matrix
+        return self.is_precalculated()
+
+    def is_precalculated(self):
+        Mkk_keys, Mnk_keys = self.required_matrices()
+        return all(k in self.Mkk for k in Mkk_keys) and all(key in self.Mnk for key in Mnk_keys)
+
+    def _store(self, name, matrix):
+        if self.cache is not None:
+            self.cache.save(self.cache_key, name, matrix,
+                            description='N_R=%d dr=%r d_alpha=%r' % (self.N_R, self.dr, self.d_alpha))
+
+    def reuse_matrices(self, other):
+        ''' takes the matrices already computed by another Abel_object with the same
+        radial grid and angular step (for example before a change of N, or of the
+        center which keeps N_R), returns the number of matrices reused.
+        Truncated matrices (see truncate) are not reused. '''
+        if (other.N_R, other.dr, other.d_alpha) != (self.N_R, self.dr, self.d_alpha):
+            return 0
+        n_reused = 0
+        for k, matrix in other.Mkk.items():
+            if k not in self.Mkk and isinstance(matrix, np.ndarray):
+                self.Mkk[k] = matrix
+                n_reused += 1
+        for key, matrix in other.Mnk.items():
+            if key not in self.Mnk and isinstance(matrix, np.ndarray):
+                self.Mnk[key] = matrix
+                n_reused += 1
+        return n_reused
+
+    def precalculate(self, n_workers=None, progress=None, cancel=None):
+        ''' computes the matrices required for N which are not there yet (loaded from
+        the cache or taken by reuse_matrices), so increasing N only computes the new ones.
+        The matrices are independent and computed concurrently by n_workers threads
+        (None: number of cores), numpy releasing the GIL in the array operations of M.
+
+        progress(done, total) is called after each matrix, always from the calling
+        thread (a GUI must forward it to its own thread, e.g. with a signal).
+        cancel is a threading.Event: when it is set, the matrices not started yet are
+        abandoned, the ones already computed are kept for the next call.
+        Returns True if all the matrices are there. '''
+        Mkk_keys, Mnk_keys = self.required_matrices()
+        todo = [(k, 0) for k in Mkk_keys if k not in self.Mkk] + \
+               [key for key in Mnk_keys if key not in self.Mnk]
+        if progress is None:
+            def progress(done, total):
+                print(int(done / total * 100), " %")
+        if not todo:
+            return True
+        n_workers = min(n_workers or os.cpu_count(), len(todo))
+        print('precalculating %d matrices with %d threads...' % (len(todo), n_workers))
+        executor = ThreadPoolExecutor(n_workers)
+        futures = {executor.submit(self.M, self.N_R, n, k): (n, k) for n, k in todo}
+        done = 0
+        for future in as_completed(futures):
+            n, k = futures[future]
+            if k == 0:
+                self.Mkk[n] = future.result()  # M_kk, solved by back-substitution in invert
+            else:
+                self.Mnk[(n, k)] = future.result()
+            self._store('M_%d_%d' % (n, k), future.result())
+            done += 1
+            progress(done, len(todo))
+            if cancel is not None and cancel.is_set():
+                break
+        executor.shutdown(wait=True, cancel_futures=True)
+        if done < len(todo):
+            print('precalculation cancelled (%d / %d matrices done)' % (done, len(todo)))
+            return False
         print('precalculation done')
+        return True
+
+    def bandwidth(self, matrix, tol):
+        ''' smallest bandwidth (number of superdiagonals kept) of the upper triangular
+        matrix such that the dropped elements have a 1-norm (maximum column sum of the
+        absolute values) of at most tol times the 1-norm of the matrix.
+        Returns (bandwidth, eps) with eps the actual relative 1-norm of the dropped part '''
+        A = np.abs(np.asarray(matrix))
+        n = A.shape[0]
+        d, j = np.arange(n)[:, None], np.arange(n)[None, :]
+        shifted = np.where(j >= d, A[np.clip(j - d, 0, None), j], 0)  # shifted[d, j] = |M[j-d, j]|
+        tail = np.cumsum(shifted[::-1], axis=0)[::-1]  # tail[d, j]: sum of the diagonals >= d
+        eps = np.append(tail[1:].max(axis=1), 0) / A.sum(axis=0).max()  # dropped beyond bandwidth u
+        bandwidth = int(np.argmax(eps <= tol))
+        return bandwidth, eps[bandwidth]
+
+    def truncate(self, tol):
+        ''' drops the far off-diagonal elements of the precalculated matrices: each matrix
+        keeps the smallest band such that the 1-norm of the dropped elements is at most
+        tol times its 1-norm. M_kk become BandedTriangular (banded back-substitution),
+        M_nk become sparse CSR matrices. The matrices already truncated are left as is.
+
+        The Abel matrices are long-range (the projection of a shell decreases only as
+        1/r far from it), so tol must be small, and R_max is usually the main saving.
+        self.truncation[name] = (bandwidth, eps, bound) where eps is the relative 1-norm
+        of the dropped part, which bounds the relative error of the products with M_nk,
+        and for M_kk bound = cond(M_kk) * eps / (1 - cond(M_kk) * eps) bounds the
+        relative error of the solve (first-order perturbation, 1-norm condition number).
+        Returns the largest bound. '''
+        memory_before = memory_after = 0
+        for k, matrix in self.Mkk.items():
+            if not isinstance(matrix, np.ndarray):
+                continue
+            bandwidth, eps = self.bandwidth(matrix, tol)
+            cond = 1 / dtrcon(np.asarray(matrix), norm='1', uplo='U')[0]
+            bound = cond * eps / (1 - cond * eps) if cond * eps < 1 else np.inf
+            self.Mkk[k] = BandedTriangular.from_dense(matrix, bandwidth)
+            self.truncation['M_%d_0' % k] = (bandwidth, eps, bound)
+            memory_before += matrix.nbytes
+            memory_after += self.Mkk[k].nbytes
+        for key, matrix in self.Mnk.items():
+            if not isinstance(matrix, np.ndarray):
+                continue
+            bandwidth, eps = self.bandwidth(matrix, tol)
+            self.Mnk[key] = sparse.csr_matrix(np.triu(matrix) - np.triu(matrix, bandwidth + 1))
+            self.truncation['M_%d_%d' % key] = (bandwidth, eps, eps)
+            memory_before += matrix.nbytes
+            memory_after += self.Mnk[key].data.nbytes + self.Mnk[key].indices.nbytes + \
+                            self.Mnk[key].indptr.nbytes
+        worst = max(bound for bandwidth, eps, bound in self.truncation.values())
+        print('matrices truncated: %.1f MB -> %.1f MB, relative error bound %.2e'
+              % (memory_before / 1e6, memory_after / 1e6, worst))
+        for name, (bandwidth, eps, bound) in sorted(self.truncation.items()):
+            print('  %s: bandwidth %d / %d, eps %.2e, bound %.2e' % (name, bandwidth, self.N_R, eps, bound))
+        return worst
+
+    def legendre_weights(self):
+        ''' (2N+1, N_alpha) matrix of the angular weights of the Legendre projection:
+        W[k] = (2k+1)/2 * |sin(alpha)| * P_k(cos(alpha)) * (trapezoidal integration weights) * 0.5
+        so that delta = W . data_polar.T '''
+        n_k = 2 * self.N + 1
+        trapz = np.full(self.N_alpha, self.d_alpha)
+        trapz[[0, -1]] *= 0.5
+        W = np.empty((n_k, self.N_alpha))
+        for k in range(0, n_k):
+            W[k] = (2 * k + 1) / 2 * np.abs(np.sin(self.alpha_vector)) * \
+                   eval_legendre(k, np.cos(self.alpha_vector)) * trapz * 0.5
+            # I added the 0.5 because we integrate between 0 and 2pi
+            # instead of between 0 and pi
+        return W
+
+    def legendre_projection(self, data_polar=None):
+        ''' (2N+1, N_R) Legendre projections delta of data_polar (default: the one
+        of set_data), all the radii at once '''
+        if data_polar is None:
+            data_polar = self.data_polar
+        return np.dot(self.W, data_polar[:self.N_R].T)
 
     def invert(self):
+        delta = self.legendre_projection()
+        self.F = self.solve(delta)
+
+    def reset_accumulation(self):
+        self.delta_sum = np.zeros((2 * self.N + 1, self.N_R))
+        self.n_accumulated = 0
+
+    def accumulate(self, data=None, delta=None):
+        ''' Adds a frame to the running sum of the Legendre projections. The
+        inversion being linear, solve_accumulated then gives the F of the sum (or
+        the mean) of all the frames added, without storing them and without a
+        solve per frame: the cost of a frame is the polar reprojection and the
+        product with W.
+
+        Parameters
+        ----------
+        data : 2D np.array or None
+            the frame (None: the data of the last set_data)
+        delta : (2N+1, N_R) array or None
+            the Legendre projections of the frame, if already computed (e.g. by
+            abel_worker.AbelWorker), data is then ignored
+        '''
+        if delta is None:
+            if data is not None:
+                self.set_data(data)
+            delta = self.legendre_projection()
+        if self.delta_sum is None:
+            self.reset_accumulation()
+        self.delta_sum += delta
+        self.n_accumulated += 1
+
+    def solve_accumulated(self, mean=True):
+        ''' F of the mean (or of the sum) of the frames added by accumulate since
+        the last reset_accumulation, also stored in self.F '''
+        if self.n_accumulated == 0:
+            self.F = {k: np.zeros(self.N_R) for k in range(2 * self.N + 1)}
+        elif mean:
+            self.F = self.solve(self.delta_sum / self.n_accumulated)
+        else:
+            self.F = self.solve(self.delta_sum)
+        return self.F
+
+    def invert_stack(self, frames, chunk_frames=64, out=None, camera_frames=False, verbose=True):
+        ''' Abel inversion of a stack of frames with the matrices of this object
+        (precalculate must have been called).
+        The frames are processed by chunks: one sparse product for the polar
+        reprojection, one product with W for the Legendre projections and one
+        triangular solve per k, with all the frames of the chunk as right-hand sides.
+
+        Parameters
+        ----------
+        frames : (n_frames, Ny, Nx) array or str
+            the frames, or the path of a .npy file (opened memory-mapped, for
+            example a file written by stream_recorder.py)
+        chunk_frames : int
+            number of frames processed at once
+        out : (n_frames, 2N+1, N_R) array or None
+            where to write the result
+        camera_frames : bool
+            the frames are in the orientation of the camera, they are transposed and
+            flipped like in the GUI before the inversion
+        verbose : bool
+            prints the progress after each chunk
+
+        Returns
+        -------
+        out : (n_frames, 2N+1, N_R) array
+            the Legendre coefficients F[k] of each frame
+        '''
+        if isinstance(frames, str):
+            frames = np.load(frames, mmap_mode='r')
+        n_frames = frames.shape[0]
+        n_k = 2 * self.N + 1
+        if out is None:
+            out = np.empty((n_frames, n_k, self.N_R))
+        t0 = time()
+        for start in range(0, n_frames, chunk_frames):
+            chunk = frames[start:start + chunk_frames]
+            if camera_frames:
+                chunk = chunk.transpose(0, 2, 1)[:, :, ::-1]
+            chunk = np.ascontiguousarray(chunk)
+            polar = self.plan.apply_stack(chunk).reshape(self.plan.polar_shape + (chunk.shape[0],))
+            delta = np.tensordot(self.W, polar, axes=([1], [1]))  # (2N+1, N_R, frames)
+            F = self.solve(delta)
+            for k in range(n_k):
+                out[start:start + chunk.shape[0], k] = F[k].T
+            if verbose:
+                print('%d / %d frames inverted (%.1f frames/s)'
+                      % (start + chunk.shape[0], n_frames, (start + chunk.shape[0]) / (time() - t0)))
+        return out
+
+    def solve(self, delta):
+        ''' Application of eqn. 19: computes the F[k] from the Legendre projections
+        delta[k] (from k=2N down to 0). M_kk is upper triangular so F[k] is obtained by
+        back-substitution instead of a product with an explicit inverse, which is
+        cheaper and more accurate at large radii.
+        delta can have a last axis of frames: delta[k] of shape (N_R, n_frames) '''
         N = self.N
-        delta = np.zeros([2 * N + 1, self.N_R])
-        for k in range(0, 2 * N + 1):
-            for Ri in range(0, self.N_R):
-                delta[k, Ri] = (2 * k + 1) / 2 * \
-                        np.trapz(np.abs(np.sin(self.alpha_vector))*\
-                        eval_legendre(k, np.cos(self.alpha_vector))*\
-                        self.data_polar[Ri, :],dx=self.d_alpha) * 0.5
-                        # I added the 0.5 because we integrate between 0 and 2pi
-                        # instead of between 0 and pi
-
-        # Application of eqn. 19
+        F = {}
         for k in range(2 * N, -1, -1):  # reversed loop from 2N to 0 included
-            if k % 2 == 0:  # even k
-                if k == 2 * N:  # no sum over i
-                    m2 = delta[k]
-                elif k == 2 * N - 2:  # only one term in the sum
-                    i = 1
-                    m2 = delta[k] - np.dot(self.Mnk[(k + 2 * i, i)], self.F[k + 2 * i])
-                else:
-                    m2 = delta[k] - np.array(
-                        [np.dot(self.Mnk[(k + 2 * i, i)], self.F[k + 2 * i]) \
-                         for i in range(1, N - k // 2 + 1)]).sum(axis=0)
-                self.F[k] = np.dot(self.M_inv[k], m2)
-            elif k % 2 == 1:  # odd k
-                m2 = delta[k] - np.array(
-                    [np.dot(self.Mnk[(k + 2 * i, i)], self.F[k + 2 * i]) \
-                     for i in range(1, N - (int(k / 2) + 1) + 1)]).sum(axis=0)
-                self.F[k] = np.dot(self.M_inv[k], m2)
+            m2 = delta[k]
+            for i in range(1, (2 * N - k) // 2 + 1):  # no sum over i for k = 2N and 2N-1
+                m2 = m2 - self.Mnk[(k + 2 * i, i)].dot(F[k + 2 * i])  # dense or sparse
+            if isinstance(self.Mkk[k], BandedTriangular):
+                F[k] = self.Mkk[k].solve(m2)
+            else:
+                F[k] = solve_triangular(self.Mkk[k], m2, lower=False, check_finite=False)
+        return F
 
 
 if __name__ == '__main__':
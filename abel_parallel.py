@@ -0,0 +1,274 @@
+""" This file defines the ParallelAbel class, which Abel inverts stacks of frames
+(arrays or .npy files written by stream_recorder.py) with a pool of worker processes,
+using the matrices precalculated by an Abel_object (abel_davis_class.py).
+
+The matrices M_kk and M_nk (dense or truncated), the Legendre weights and the polar reprojection plan are
+copied once in shared memory blocks, which the workers attach to when they start, so
+nothing but slot numbers is sent with the tasks. The frames also go through shared
+memory: the frames of a chunk are copied in a free input slot, and the worker writes
+their Legendre coefficients in the output slot of the same number. At most 2 chunks
+per worker are in flight, and the results are returned in the order of the frames.
+
+python abel_parallel.py [n_frames] [size] measures the throughput for 1, 2, 4,...
+workers up to the number of cores.
+"""
+
+import os
+import sys
+from time import time
+from collections import deque
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from scipy import sparse
+
+from abel_davis_class import Abel_object, PolarPlan, BandedTriangular
+
+
+def _share(arrays):
+    """ creates one shared memory block per item of arrays, which is either an array
+    (copied in the block) or a (shape, dtype) tuple (block left uninitialized).
+    Returns the blocks, the arrays using them and their description for _attach"""
+    blocks, shared, description = [], {}, {}
+    for name, array in arrays.items():
+        if isinstance(array, tuple):
+            shape, dtype = array[0], np.dtype(array[1])
+        else:
+            shape, dtype = array.shape, array.dtype
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        if not isinstance(array, tuple):
+            shared[name][...] = array
+        blocks.append(shm)
+        description[name] = (shm.name, shape, dtype.str)
+    return blocks, shared, description
+
+
+def _attach(description):
+    """ arrays of the shared memory blocks created by _share (in a worker)"""
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in description.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return blocks, arrays
+
+
+def _matrix_arrays(name, matrix):
+    """ arrays to share for a matrix of Abel_object (dense, BandedTriangular or
+    sparse, see Abel_object.truncate) and its kind, used by _matrix"""
+    if isinstance(matrix, BandedTriangular):
+        return {name: matrix.ab.T}, ('banded',)  # C-contiguous transposed of the Fortran layout
+    if sparse.issparse(matrix):
+        return {name + '_data': matrix.data, name + '_indices': matrix.indices,
+                name + '_indptr': matrix.indptr}, ('csr', matrix.shape)
+    return {name: matrix}, ('dense',)
+
+
+def _matrix(name, kind, arrays):
+    """ matrix using the shared arrays (in a worker)"""
+    if kind[0] == 'banded':
+        return BandedTriangular(arrays[name].T)
+    if kind[0] == 'csr':
+        return sparse.csr_matrix((arrays[name + '_data'], arrays[name + '_indices'],
+                                  arrays[name + '_indptr']), shape=kind[1], copy=False)
+    return arrays[name]
+
+
+# state of a worker process, set by _init_worker
+_blocks = []
+_arrays = {}
+_abel = None
+_camera_frames = False
+
+
+def _init_worker(description, info):
+    global _blocks, _arrays, _abel, _camera_frames
+    try:  # one BLAS thread per worker, the parallelism comes from the processes
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    _blocks, _arrays = _attach(description)
+    _camera_frames = info['camera_frames']
+
+    # Abel_object and PolarPlan using the shared arrays (no precalculation)
+    plan = PolarPlan.__new__(PolarPlan)
+    plan.shape, plan.polar_shape, plan.use_sparse = info['shape'], info['polar_shape'], True
+    plan.matrix = sparse.csr_matrix(
+        (_arrays['plan_data'], _arrays['plan_indices'], _arrays['plan_indptr']),
+        shape=info['plan_matrix_shape'], copy=False)
+    _abel = Abel_object.__new__(Abel_object)
+    _abel.N, _abel.N_R, _abel.plan, _abel.W = info['N'], info['N_R'], plan, _arrays['W']
+    kinds = info['matrix_kinds']
+    _abel.Mkk = {k: _matrix('M_%d_0' % k, kinds['M_%d_0' % k], _arrays) for k in info['Mkk_keys']}
+    _abel.Mnk = {key: _matrix('M_%d_%d' % key, kinds['M_%d_%d' % key], _arrays)
+                 for key in info['Mnk_keys']}
+
+
+def _invert_chunk(slot, n_frames):
+    """ inverts the n_frames first frames of the input slot in the output slot"""
+    _abel.invert_stack(_arrays['input'][slot, :n_frames], chunk_frames=n_frames,
+                       out=_arrays['output'][slot, :n_frames],
+                       camera_frames=_camera_frames, verbose=False)
+    return slot
+
+
+class ParallelAbel(object):
+    """
+    Pool of worker processes inverting frames with the matrices of abel_obj.
+
+    Parameters
+    ----------
+    abel_obj : Abel_object
+        gives the geometry and the matrices (precalculate must have been called)
+    n_workers : int or None
+        number of processes (None: number of cores)
+    chunk_frames : int
+        number of frames sent to a worker at once
+    camera_frames : bool
+        the frames are in the orientation of the camera (see Abel_object.invert_stack)
+    dtype : numpy dtype
+        dtype of the shared input slots (the frames are converted to it)
+    """
+    def __init__(self, abel_obj, n_workers=None, chunk_frames=16, camera_frames=False,
+                 dtype=np.uint16):
+        if not abel_obj.is_precalculated():
+            raise ValueError('the Abel matrices must be precalculated first')
+        self.n_workers = n_workers or os.cpu_count()
+        self.chunk_frames = chunk_frames
+        self.n_slots = 2 * self.n_workers
+        plan = abel_obj.plan
+        self.frame_shape = plan.shape[::-1] if camera_frames else plan.shape
+        n_k = 2 * abel_obj.N + 1
+
+        if plan.use_sparse:
+            matrix = plan.matrix
+        else:
+            points = np.tile(np.arange(plan.indices.shape[1]), 4)
+            matrix = sparse.csr_matrix((plan.weights.ravel(), (points, plan.indices.ravel())),
+                                       shape=(plan.indices.shape[1], plan.shape[0] * plan.shape[1]))
+        Mkk_keys, Mnk_keys = abel_obj.required_matrices()
+        arrays = {'W': abel_obj.W, 'plan_data': matrix.data, 'plan_indices': matrix.indices,
+                  'plan_indptr': matrix.indptr,
+                  'input': ((self.n_slots, chunk_frames) + self.frame_shape, dtype),
+                  'output': ((self.n_slots, chunk_frames, n_k, abel_obj.N_R), np.float64)}
+        matrix_kinds = {}
+        matrices = [('M_%d_0' % k, abel_obj.Mkk[k]) for k in Mkk_keys] + \
+                   [('M_%d_%d' % key, abel_obj.Mnk[key]) for key in Mnk_keys]
+        for name, M in matrices:
+            matrix_arrays, matrix_kinds[name] = _matrix_arrays(name, M)
+            arrays.update(matrix_arrays)
+        self._blocks, shared, description = _share(arrays)
+        self.input, self.output = shared['input'], shared['output']
+
+        info = {'N': abel_obj.N, 'N_R': abel_obj.N_R, 'shape': plan.shape,
+                'polar_shape': plan.polar_shape, 'plan_matrix_shape': matrix.shape,
+                'camera_frames': camera_frames, 'Mkk_keys': Mkk_keys, 'Mnk_keys': Mnk_keys,
+                'matrix_kinds': matrix_kinds}
+        self.pool = multiprocessing.Pool(self.n_workers, initializer=_init_worker,
+                                         initargs=(description, info))
+        self.stats = {'frames': 0, 'time': 0., 'fps': 0.}
+
+    def imap(self, frames):
+        """
+        Generator of (start, F) in the order of the frames, where F is the
+        (n, 2N+1, N_R) array of the Legendre coefficients of frames[start:start+n].
+        F is in a shared slot which is reused: it is only valid until the next
+        iteration. frames is an (n_frames, ...) array or the path of a .npy file.
+        """
+        if isinstance(frames, str):
+            frames = np.load(frames, mmap_mode='r')
+        if frames.shape[1:] != self.frame_shape:
+            raise ValueError('Incorrect data shape')
+        n_frames = frames.shape[0]
+        starts = iter(range(0, n_frames, self.chunk_frames))
+        free_slots = deque(range(self.n_slots))
+        in_flight = deque()
+        t0 = time()
+        while True:
+            # fills the free slots while the workers compute
+            while free_slots:
+                start = next(starts, None)
+                if start is None:
+                    break
+                slot = free_slots.popleft()
+                n = min(self.chunk_frames, n_frames - start)
+                self.input[slot, :n] = frames[start:start + n]
+                in_flight.append((start, n, self.pool.apply_async(_invert_chunk, (slot, n))))
+            if not in_flight:
+                break
+            start, n, result = in_flight.popleft()
+            slot = result.get()
+            self.stats['frames'] += n
+            self.stats['time'] = time() - t0
+            self.stats['fps'] = self.stats['frames'] / max(self.stats['time'], 1e-9)
+            yield start, self.output[slot, :n]
+            free_slots.append(slot)
+
+    def invert_stack(self, frames, out=None, verbose=True):
+        """ same as Abel_object.invert_stack, with the worker processes"""
+        if isinstance(frames, str):
+            frames = np.load(frames, mmap_mode='r')
+        n_frames = frames.shape[0]
+        if out is None:
+            out = np.empty((n_frames,) + self.output.shape[2:])
+        self.stats = {'frames': 0, 'time': 0., 'fps': 0.}
+        for start, F in self.imap(frames):
+            out[start:start + F.shape[0]] = F
+            if verbose:
+                print('%d / %d frames inverted (%.1f frames/s)'
+                      % (start + F.shape[0], n_frames, self.stats['fps']))
+        return out
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        del self.input, self.output
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def benchmark(abel_obj, frames, worker_counts=None, chunk_frames=16):
+    """ prints the throughput (frames/s) of abel_obj.invert_stack and of ParallelAbel
+    for each number of workers, returns {n_workers: fps} (0 for invert_stack)"""
+    if worker_counts is None:
+        worker_counts, n = [], 1
+        while n < os.cpu_count():
+            worker_counts.append(n)
+            n *= 2
+        worker_counts.append(os.cpu_count())
+    t0 = time()
+    abel_obj.invert_stack(frames, chunk_frames=chunk_frames, verbose=False)
+    fps = {0: frames.shape[0] / (time() - t0)}
+    print('single process: %.1f frames/s' % fps[0])
+    for n_workers in worker_counts:
+        with ParallelAbel(abel_obj, n_workers, chunk_frames, dtype=frames.dtype) as engine:
+            engine.invert_stack(frames, verbose=False)
+            fps[n_workers] = engine.stats['fps']
+        print('%d workers: %.1f frames/s (x%.2f)' % (n_workers, fps[n_workers], fps[n_workers] / fps[0]))
+    return fps
+
+
+if __name__ == '__main__':
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+
+    # noisy images of two isotropic rings
+    y, x = np.indices((size, size)) - size // 2
+    r = np.sqrt(x**2 + y**2)
+    image = 50 * np.exp(-(r - size / 4)**2 / 20) + 20 * np.exp(-(r - size / 3)**2 / 50)
+    frames = np.random.default_rng(0).poisson(image, (n_frames, size, size)).astype(np.uint16)
+
+    abel_obj = Abel_object(frames[0], size // 2, size // 2, 1, 1, 1)
+    abel_obj.precalculate()
+    benchmark(abel_obj, frames)
@@ -0,0 +1,157 @@
+""" This file defines the AbelWorker class, a thread which Abel inverts the live images
+with the matrices of a precalculated Abel_object (abel_davis_class.py), so that the
+inversion never delays the acquisition nor the display.
+
+Latest-frame semantics: submit copies an image in the input slot and returns at once.
+If the worker is still busy with the previous image when a new one is submitted, the
+image waiting in the slot is replaced (it is skipped), so the worker always inverts the
+newest image and never accumulates a backlog. The two input buffers are swapped when
+the worker takes an image, so submit never writes in the buffer being inverted.
+
+The Legendre coefficients F of the last inversion are published in a double-buffered
+result slot: the worker writes in the back buffer and swaps it with the front one,
+latest copies the front buffer (a few kB) for the GUI.
+
+In accumulation mode (set_accumulate), the Legendre projections of the images are
+summed with Abel_object.accumulate and the mean is solved at most every solve_interval
+seconds (the display rate) or when the worker is idle, so an image only costs its
+polar reprojection and the spectrum converges as images are added. The images skipped
+by the worker are not in the sum.
+"""
+
+from threading import Thread, Condition
+from time import perf_counter
+import sys
+import traceback
+import numpy as np
+
+
+class AbelWorker(Thread):
+    """
+    Thread inverting the newest submitted image.
+
+    Parameters
+    ----------
+    abel_obj : Abel_object
+        gives the geometry and the matrices (precalculate must have been called).
+        Its data_polar is not modified, the worker has its own buffers (its running
+        sum and F are used in accumulation mode)
+    dtype : numpy dtype
+        dtype of the input buffers (the images are converted to it)
+    solve_interval : float
+        minimum time (in s) between two solves in accumulation mode
+    """
+    def __init__(self, abel_obj, dtype=np.float32, solve_interval=0.05):
+        Thread.__init__(self, daemon=True)
+        if not abel_obj.is_precalculated():
+            raise ValueError('the Abel matrices must be precalculated first')
+        self.abel = abel_obj
+        shape = (abel_obj.Ny, abel_obj.Nx)
+        self._inputs = [np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype)]
+        self._pending = None  # (frame_id, submission time) of the image in self._inputs[0]
+        self._polar = np.empty(abel_obj.plan.polar_shape)
+        self._results = np.zeros((2, 2 * abel_obj.N + 1, abel_obj.N_R))
+        self._front = 0
+        self._result_id = None  # frame_id of the front result
+        self._new_result = False
+        self._condition = Condition()
+        self._stop_requested = False
+        self.accumulating = False
+        self._reset_requested = False
+        self.solve_interval = solve_interval
+        self._t_solve = 0.
+        self.stats = {'submitted': 0, 'inverted': 0, 'skipped': 0, 'skip_ratio': 0.,
+                      'latency': 0., 'inversion_time': 0., 'accumulated': 0}
+
+    def submit(self, image, frame_id=None):
+        """ copies image in the input slot, replacing the image waiting there if the
+        worker has not taken it yet (it is then counted as skipped)"""
+        if image.shape != self._inputs[0].shape:
+            raise ValueError('Incorrect data shape')
+        with self._condition:
+            np.copyto(self._inputs[0], image, casting='unsafe')
+            self.stats['submitted'] += 1
+            if self._pending is not None:
+                self.stats['skipped'] += 1
+            self.stats['skip_ratio'] = self.stats['skipped'] / self.stats['submitted']
+            self._pending = (frame_id, perf_counter())
+            self._condition.notify()
+
+    def set_accumulate(self, accumulate):
+        """ switches the accumulation mode, the sum restarts from the next image"""
+        with self._condition:
+            self.accumulating = accumulate
+            self._reset_requested = True
+
+    def latest(self, out=None):
+        """ (F, frame_id) of the last inversion, F being a (2N+1, N_R) array copied in
+        out (or a new array), or None if there is no new result since the last call"""
+        with self._condition:
+            if not self._new_result:
+                return None
+            self._new_result = False
+            if out is None:
+                out = np.empty_like(self._results[0])
+            np.copyto(out, self._results[self._front])
+            return out, self._result_id
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stop_requested:
+                    self._condition.wait()
+                if self._stop_requested:
+                    return
+                self._inputs.reverse()  # the image to invert is now in self._inputs[1]
+                frame_id, t_submit = self._pending
+                self._pending = None
+                accumulating = self.accumulating
+                if self._reset_requested:
+                    self.abel.reset_accumulation()
+                    self._reset_requested = False
+            try:
+                t0 = perf_counter()
+                if accumulating:
+                    F = self.accumulate(self._inputs[1])
+                    if F is None:  # not solved this time
+                        continue
+                else:
+                    F = self.invert(self._inputs[1])
+                back = 1 - self._front
+                for k in range(self._results.shape[1]):
+                    self._results[back, k] = F[k]
+                t1 = perf_counter()
+                with self._condition:
+                    self._front = back
+                    self._result_id = frame_id
+                    self._new_result = True
+                    self.stats['inverted'] += 1
+                    self.stats['latency'] = t1 - t_submit
+                    self.stats['inversion_time'] = t1 - t0
+                    self.stats['accumulated'] = self.abel.n_accumulated if accumulating else 0
+            except Exception:
+                print(traceback.format_exception(*sys.exc_info()))
+
+    def invert(self, image):
+        """ same as Abel_object.set_data followed by Abel_object.invert, in the
+        buffers of the worker. Returns F (dict k: array of N_R values)"""
+        self.abel.plan.apply(image, out=self._polar)
+        return self.abel.solve(self.abel.legendre_projection(self._polar))
+
+    def accumulate(self, image):
+        """ adds image to the running sum, returns the F of the mean if it is time to
+        solve (solve_interval elapsed or no image waiting), else None"""
+        self.abel.plan.apply(image, out=self._polar)
+        self.abel.accumulate(delta=self.abel.legendre_projection(self._polar))
+        t = perf_counter()
+        if t - self._t_solve < self.solve_interval and self._pending is not None:
+            return None
+        self._t_solve = t
+        return self.abel.solve_accumulated()
+
+    def stop(self, timeout=None):
+        """ stops the thread (after the inversion in progress)"""
+        with self._condition:
+            self._stop_requested = True
+            self._condition.notify()
+        self.join(timeout)
@@ -0,0 +1,117 @@
+""" This file defines the BackgroundModel class, a background built from several frames
+instead of a single snapshot, to reduce the noise added by the background subtraction.
+
+The background is kept in a float32 buffer (self.bkg) which is updated in place when a
+frame is added, so it can be built during the live view while it is being subtracted
+(FrameProcessor uses a float32 background without any copy). The median of the
+last frames is computed in a thread, so that it never stalls the display.
+"""
+
+from threading import Thread
+import numpy as np
+
+
+class BackgroundModel(object):
+    """
+    Background accumulated from frames (in the orientation of the displayed images).
+
+    Parameters
+    ----------
+    mode : str
+        'mean': mean of all the frames added since the last reset
+        'ema': exponential moving average, each new frame having the weight alpha
+        'median': median of the last n_median frames. It is too slow to be recomputed
+        at every frame, so it is recomputed every n_median frames and when update()
+        is called, in a thread (the background is replaced when it is done)
+    alpha : float
+        weight of a new frame in 'ema' mode
+    n_median : int
+        number of frames kept in 'median' mode
+    """
+    modes = ['mean', 'ema', 'median']
+
+    def __init__(self, mode='mean', alpha=0.05, n_median=15):
+        if mode not in self.modes:
+            raise ValueError('Unknown background mode: ' + mode)
+        self.mode = mode
+        self.alpha = alpha
+        self.n_median = n_median
+        self.bkg = None  # float32 background, None until a frame is added
+        self.n_frames = 0  # frames added since the last reset
+        self._tmp = None
+        self._stack = None  # last n_median frames ('median' mode)
+        self._median_dirty = False
+        self._median_thread = None
+        self._generation = 0  # incremented by reset, a median of older frames is discarded
+
+    def reset(self):
+        """ the next frame added replaces the background (the buffer is kept)"""
+        self.n_frames = 0
+        self._stack = None
+        self._median_dirty = False
+        self._generation += 1
+
+    def set_mode(self, mode):
+        if mode not in self.modes:
+            raise ValueError('Unknown background mode: ' + mode)
+        if mode != self.mode:
+            self.mode = mode
+            self.reset()
+
+    def _allocate(self, shape):
+        if self.bkg is None or self.bkg.shape != shape:
+            self.bkg = np.zeros(shape, dtype=np.float32)
+            self._tmp = np.empty(shape, dtype=np.float32)
+            self.reset()
+
+    def set(self, image):
+        """ the background becomes image (like a snapshot), the next frames added are
+        averaged with it"""
+        self._allocate(image.shape)
+        self.reset()
+        self.add(image)
+
+    def add(self, image):
+        """ adds a frame to the background, in place"""
+        self._allocate(image.shape)
+        self.n_frames += 1
+        if self.mode == 'median':
+            if self._stack is None:
+                self._stack = np.empty((self.n_median,) + image.shape, dtype=image.dtype)
+            self._stack[(self.n_frames - 1) % self.n_median] = image
+            self._median_dirty = True
+            if self.n_frames == 1:  # the median of one frame
+                np.copyto(self.bkg, image, casting='unsafe')
+                self._median_dirty = False
+            elif self.n_frames % self.n_median == 0:
+                self.update()
+            return
+        if self.mode == 'mean':
+            weight = 1. / self.n_frames
+        else:  # 'ema', the first frame initializes the background
+            weight = 1. if self.n_frames == 1 else self.alpha
+        # bkg += weight * (image - bkg), without temporary arrays
+        np.subtract(image, self.bkg, out=self._tmp, casting='unsafe')
+        self._tmp *= weight
+        self.bkg += self._tmp
+
+    def update(self, wait=False):
+        """ recomputes the median of the frames kept ('median' mode) in a thread. If a
+        computation is already running, the median stays to be recomputed at the next
+        call. wait: blocks until the background is updated"""
+        running = self._median_thread is not None and self._median_thread.is_alive()
+        if self.mode == 'median' and self._median_dirty and not running:
+            n = min(self.n_frames, self.n_median)
+            self._median_dirty = False
+            # np.median works on a copy of the frames (taken at its start), so the
+            # frames added meanwhile do not disturb it
+            self._median_thread = Thread(target=self._compute_median, daemon=True,
+                                         args=(self._stack[:n], self.bkg, self._generation))
+            self._median_thread.start()
+        if wait and self._median_thread is not None:
+            self._median_thread.join()
+
+    def _compute_median(self, stack, bkg, generation):
+        median = np.median(stack, axis=0)
+        if generation == self._generation:  # not reset meanwhile
+            np.copyto(bkg, median, casting='unsafe')
@@ -0,0 +1,185 @@
+""" This file finds the center of VMI images, which are symmetric with respect to their
+center (rotation by 180 degrees).
+
+The autoconvolution of an image, f * f (s) = sum_p f(p) f(s - p), is maximum for
+s = 2 * center when the image is point symmetric, and it is computed with two FFTs.
+find_center first looks for the peak on a downsampled image (cheap FFTs of the whole
+image), then refines it at full resolution on a window around the first estimate,
+with a sub-pixel (parabolic) interpolation of the peak.
+
+CenterTracker is a thread which accumulates the live images (with a BackgroundModel,
+as a mean or an exponential moving average to follow a slow drift) and estimates the
+center every interval seconds, reporting the drift from a reference center (the one
+of the current Abel inversion), so that the polar plan is only rebuilt when the
+center has moved by more than a tolerance.
+"""
+
+from threading import Thread, Condition
+from time import perf_counter
+import sys
+import traceback
+import numpy as np
+from scipy import fft
+
+from frame_processing import downsample
+from background_model import BackgroundModel
+
+
+def _parabolic_offset(y_minus, y_0, y_plus):
+    """ position of the maximum of the parabola through (-1, y_minus), (0, y_0),
+    (1, y_plus), relative to 0"""
+    denominator = y_minus - 2 * y_0 + y_plus
+    if denominator >= 0:  # not a maximum (flat peak)
+        return 0.
+    return 0.5 * (y_minus - y_plus) / denominator
+
+
+def symmetry_center(image):
+    """ (row, column) center of point symmetry of image, with sub-pixel precision"""
+    h, w = image.shape
+    f = image - image.mean(dtype=np.float64)  # else the peak is pulled to the middle
+    shape = (2 * h, 2 * w)  # zero padding: linear, not circular, convolution
+    F = fft.rfft2(f, s=shape, workers=-1)
+    conv = fft.irfft2(F * F, s=shape, workers=-1)
+    peak = np.unravel_index(np.argmax(conv), shape)
+    offsets = [_parabolic_offset(conv[(peak[0] - 1) % shape[0], peak[1]], conv[peak],
+                                 conv[(peak[0] + 1) % shape[0], peak[1]]),
+               _parabolic_offset(conv[peak[0], (peak[1] - 1) % shape[1]], conv[peak],
+                                 conv[peak[0], (peak[1] + 1) % shape[1]])]
+    return (peak[0] + offsets[0]) / 2, (peak[1] + offsets[1]) / 2
+
+
+def find_center(image, factor=4, window=256):
+    """
+    Center of a VMI image.
+
+    Parameters
+    ----------
+    image : 2D np.array
+        in the orientation of the GUI (the result is (center_x, center_y) like in
+        Abel_object)
+    factor : int
+        downsampling factor of the first estimate (1: no first estimate)
+    window : int
+        half size of the window of the refinement at full resolution (None: the
+        whole image, without first estimate)
+
+    Returns
+    -------
+    (center_x, center_y) : floats
+    """
+    if window is None:
+        return symmetry_center(image)
+    if factor > 1:
+        small = downsample(image, factor, mode='mean')
+        coarse = [(c + 0.5) * factor - 0.5 for c in symmetry_center(small)]
+    else:
+        coarse = [(n - 1) / 2 for n in image.shape]
+    # window around the first estimate (inside the image)
+    starts = [int(min(max(round(c) - window, 0), max(n - 2 * window, 0)))
+              for c, n in zip(coarse, image.shape)]
+    crop = image[starts[0]:starts[0] + 2 * window, starts[1]:starts[1] + 2 * window]
+    fine = symmetry_center(crop)
+    return starts[0] + fine[0], starts[1] + fine[1]
+
+
+class CenterTracker(Thread):
+    """
+    Thread estimating the center of the accumulated live images.
+
+    submit copies an image in an input slot (replacing the previous one if the thread
+    has not taken it yet, like AbelWorker), the thread adds it to the accumulated image
+    and calls find_center on it every interval seconds. The last estimate is in
+    self.center, its distance to self.reference in self.drift, and callback(center,
+    drift) is called (in the thread) after each estimate.
+
+    Parameters
+    ----------
+    reference : (center_x, center_y)
+        center used by the inversion, the drift is measured from it
+    callback : function or None
+        called with ((center_x, center_y), drift) after each estimate
+    interval : float
+        time between two estimates (in s)
+    mode, alpha : see BackgroundModel
+        'mean' of all the images, or 'ema' to follow a drift
+    factor, window : see find_center
+    """
+    def __init__(self, reference, callback=None, interval=2., mode='ema', alpha=0.05,
+                 factor=4, window=256):
+        Thread.__init__(self, daemon=True)
+        self.reference = reference
+        self.callback = callback
+        self.interval = interval
+        self.factor = factor
+        self.window = window
+        self.accumulated = BackgroundModel(mode=mode, alpha=alpha)
+        self._inputs = [None, None]
+        self._pending = False
+        self._condition = Condition()
+        self._stop_requested = False
+        self._t_estimate = perf_counter()
+        self.center = None
+        self.drift = 0.
+        self.stats = {'submitted': 0, 'accumulated': 0, 'estimates': 0, 'estimate_time': 0.}
+
+    def submit(self, image):
+        with self._condition:
+            if self._inputs[0] is None or self._inputs[0].shape != image.shape:
+                self._inputs = [np.empty(image.shape, dtype=np.float32) for _ in range(2)]
+            np.copyto(self._inputs[0], image, casting='unsafe')
+            self.stats['submitted'] += 1
+            self._pending = True
+            self._condition.notify()
+
+    def set_reference(self, reference):
+        """ new center of the inversion (after a rebuild of the plan)"""
+        with self._condition:
+            self.reference = reference
+            if self.center is not None:
+                self.drift = float(np.hypot(self.center[0] - reference[0], self.center[1] - reference[1]))
+
+    def reset(self):
+        """ the accumulation restarts from the next image"""
+        with self._condition:
+            self.accumulated.reset()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stop_requested:
+                    self._condition.wait()
+                if self._stop_requested:
+                    return
+                self._inputs.reverse()  # the image to add is now in self._inputs[1]
+                self._pending = False
+                self.accumulated.add(self._inputs[1])
+                self.stats['accumulated'] = self.accumulated.n_frames
+            if perf_counter() - self._t_estimate < self.interval:
+                continue
+            try:
+                self.estimate()
+            except Exception:
+                print(traceback.format_exception(*sys.exc_info()))
+
+    def estimate(self):
+        """ center of the accumulated image (in the thread, called by run)"""
+        t0 = perf_counter()
+        self.accumulated.update()  # 'median' mode
+        center = find_center(self.accumulated.bkg, self.factor, self.window)
+        t1 = perf_counter()
+        self._t_estimate = t1
+        with self._condition:
+            self.center = center
+            self.drift = float(np.hypot(center[0] - self.reference[0], center[1] - self.reference[1]))
+            self.stats['estimates'] += 1
+            self.stats['estimate_time'] = t1 - t0
+            drift = self.drift
+        if self.callback is not None:
+            self.callback(center, drift)
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stop_requested = True
+            self._condition.notify()
+        self.join(timeout)
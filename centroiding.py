@@ -0,0 +1,298 @@
+""" This file defines the event mode: instead of dense frames, the photon hits are kept
+as a list of events (x, y, I, frame_id), which is a few kB per frame instead of 8 MB.
+
+find_events detects the blobs of connected pixels above a threshold (with the same
+convention as the thresholding of the GUI: if signal <= cor1 the pixel is 0, else
+signal -= cor0) and computes their intensity weighted centroids with sub-pixel
+precision. The connected components are labelled with scipy.ndimage.label, then all the
+sums are done with np.bincount over the pixels above the threshold only.
+
+The coordinates are those of the images displayed by the GUI and inverted by
+Abel_object: x is the row and y the column (like center_x and center_y), also when the
+events are found in a frame in the orientation of the camera (camera_frames=True,
+the frame is then not reoriented).
+
+HitHistogram accumulates events in a cartesian image and directly in the polar grid
+of an Abel_object, which is then inverted without any reprojection.
+
+EventRecorder is a thread which, like StreamRecorder, reads the live frames of the
+camera and writes their events to a .npy file (one structured array of EVENT_DTYPE
+whose header is rewritten at every chunk, so it can be opened during the recording).
+"""
+
+import sys
+import time
+import threading
+from threading import Thread
+from queue import Empty
+import numpy as np
+from scipy import ndimage
+
+from stream_recorder import npy_header
+
+EVENT_DTYPE = np.dtype([('x', np.float32), ('y', np.float32), ('I', np.float32),
+                        ('frame_id', np.uint32)])
+HEADER_SIZE = 192  # bytes reserved for the .npy header (the descr of EVENT_DTYPE is long)
+
+# 8-connectivity: pixels touching by a corner belong to the same blob
+STRUCTURE_8 = np.ones((3, 3), dtype=bool)
+
+
+def find_events(image, threshold, offset=0, frame_id=0, min_pixels=1, camera_frames=False,
+                connectivity=8):
+    """
+    Events (blobs of connected pixels above threshold) of an image.
+
+    Parameters
+    ----------
+    image : 2D np.array
+    threshold : number
+        pixels <= threshold are ignored (cor1 of the GUI)
+    offset : number
+        subtracted from the pixels above threshold (cor0 of the GUI), the centroids
+        are weighted by the result
+    frame_id : int
+        stored in the events
+    min_pixels : int
+        smaller blobs are ignored (e.g. hot pixels)
+    camera_frames : bool
+        the image is in the orientation of the camera, the coordinates are computed
+        for the transposed and flipped image, like in the GUI
+    connectivity : 4 or 8
+
+    Returns
+    -------
+    events : 1D array of EVENT_DTYPE
+    """
+    mask = image > threshold
+    labels, n_events = ndimage.label(mask, structure=STRUCTURE_8 if connectivity == 8 else None)
+    if n_events == 0:
+        return np.empty(0, dtype=EVENT_DTYPE)
+    pixels = np.flatnonzero(mask)
+    label = labels.ravel()[pixels] - 1
+    weights = image.ravel()[pixels] - np.float64(offset)
+    rows, cols = np.divmod(pixels, image.shape[1])
+
+    intensity = np.bincount(label, weights, minlength=n_events)
+    row_sum = np.bincount(label, weights * rows, minlength=n_events)
+    col_sum = np.bincount(label, weights * cols, minlength=n_events)
+    keep = intensity > 0
+    if min_pixels > 1:
+        keep &= np.bincount(label, minlength=n_events) >= min_pixels
+
+    events = np.empty(np.count_nonzero(keep), dtype=EVENT_DTYPE)
+    row, col = row_sum[keep] / intensity[keep], col_sum[keep] / intensity[keep]
+    if camera_frames:  # pixel (r, c) of the camera is (c, H-1-r) in the GUI
+        events['x'], events['y'] = col, image.shape[0] - 1 - row
+    else:
+        events['x'], events['y'] = row, col
+    events['I'] = intensity[keep]
+    events['frame_id'] = frame_id
+    return events
+
+
+def events_from_stack(frames, threshold, offset=0, first_id=0, **kwargs):
+    """ events of all the frames of a stack ((n_frames, ...) array or the path of a
+    .npy file, e.g. written by stream_recorder.py), see find_events"""
+    if isinstance(frames, str):
+        frames = np.load(frames, mmap_mode='r')
+    return np.concatenate([find_events(frame, threshold, offset, first_id + i, **kwargs)
+                           for i, frame in enumerate(frames)] or [np.empty(0, dtype=EVENT_DTYPE)])
+
+
+class HitHistogram(object):
+    """
+    Accumulation of events in a cartesian image and in a polar (r, alpha) histogram
+    on the grid of the PolarPlan of an Abel_object, so that the inversion can be fed
+    directly (Abel_object.set_polar_data) without any reprojection. Only the two
+    histograms are kept, whatever the number of events.
+
+    Each event is put in the nearest bin (the bins are centered on the points of the
+    polar grid). The polar histogram is divided by the area of a bin (dr * d_alpha) in
+    polar_data, which gives the image times r, like PolarPlan.apply does.
+
+    Parameters
+    ----------
+    plan : PolarPlan
+        gives the shape of the images, the center and the polar grid (abel_obj.plan
+        for an Abel_object)
+    binning : int
+        the cartesian image (float32) is binned by this factor in both directions
+        (2048 x 2048 pixels: 16 MB, 4 MB with binning=2)
+    weighted : bool
+        each event counts for its intensity I instead of 1
+    """
+    def __init__(self, plan, binning=1, weighted=False):
+        self.plan = plan
+        self.binning = binning
+        self.weighted = weighted
+        # spacings of the grid (the radii are i * dr, the angular extent of the image
+        # is divided in bins of at most d_alpha)
+        self.dr = plan.r_vector[1] - plan.r_vector[0] if len(plan.r_vector) > 1 else 1.
+        self.d_alpha = plan.theta_vector[1] - plan.theta_vector[0]
+        self.polar_shape = plan.polar_shape
+        self.image = np.zeros((plan.shape[0] // binning, plan.shape[1] // binning), dtype=np.float32)
+        self.polar = np.zeros(self.polar_shape)
+        self.n_events = 0
+        self.n_frames = 0
+
+    def reset(self):
+        self.image[...] = 0
+        self.polar[...] = 0
+        self.n_events = 0
+        self.n_frames = 0
+
+    def add(self, events, n_frames=1):
+        """ adds events (array of EVENT_DTYPE), found in n_frames frames"""
+        weights = events['I'].astype(np.float64) if self.weighted else None
+        x, y = events['x'].astype(np.float64), events['y'].astype(np.float64)
+
+        rows = np.around(x).astype(np.int64) // self.binning
+        cols = np.around(y).astype(np.int64) // self.binning
+        inside = (rows >= 0) & (rows < self.image.shape[0]) & (cols >= 0) & (cols < self.image.shape[1])
+        np.add.at(self.image.ravel(), rows[inside] * self.image.shape[1] + cols[inside],
+                  1 if weights is None else weights[inside])
+
+        px, py = y - self.plan.origin[1], self.plan.origin[0] - x  # like in PolarPlan
+        r_bin = np.around(np.sqrt(px**2 + py**2) / self.dr).astype(np.int64)
+        t_bin = np.around((np.arctan2(px, py) - self.plan.theta_vector[0]) / self.d_alpha).astype(np.int64)
+        t_bin %= self.polar_shape[1]  # alpha = pi is the same direction as -pi
+        inside = (r_bin >= 0) & (r_bin < self.polar_shape[0])
+        np.add.at(self.polar.ravel(), r_bin[inside] * self.polar_shape[1] + t_bin[inside],
+                  1 if weights is None else weights[inside])
+        self.n_events += events.size
+        self.n_frames += n_frames
+
+    def add_frame(self, image, threshold, offset=0, **kwargs):
+        """ adds the events of a (thresholded) frame, see find_events"""
+        self.add(find_events(image, threshold, offset, self.n_frames, **kwargs))
+
+    def polar_data(self, mean=True):
+        """ polar image (per frame if mean) to give to Abel_object.set_polar_data"""
+        scale = self.dr * self.d_alpha * (max(self.n_frames, 1) if mean else 1)
+        return self.polar / scale
+
+    def nbytes(self):
+        return self.image.nbytes + self.polar.nbytes
+
+
+class EventRecorder(Thread):
+    """
+    Thread writing the events of the frames of a live acquisition to path (.npy).
+
+    Parameters
+    ----------
+    cam : PCOEdge
+        camera in live acquisition (record_live), read like in StreamRecorder
+    path : str
+        output file, '.npy' is added if needed
+    threshold, offset, min_pixels : see find_events
+    max_frames : int or None
+        stops after this number of frames (None: until stop() is called)
+    chunk_frames : int
+        the events are written every chunk_frames frames
+    """
+    def __init__(self, cam, path, threshold, offset=0, min_pixels=1, max_frames=None,
+                 chunk_frames=16):
+        Thread.__init__(self, daemon=True)
+        self._stop_event = threading.Event()
+        self.cam = cam
+        if not path.endswith('.npy'):
+            path += '.npy'
+        self.path = path
+        self.threshold = threshold
+        self.offset = offset
+        self.min_pixels = min_pixels
+        self.max_frames = max_frames
+        self.chunk_frames = chunk_frames
+
+        if cam.handoff_mode == 'copy':
+            self.reader = cam.ring.reader()
+            self.frame = np.empty(cam.ring.shape, dtype=cam.ring.dtype)
+        else:
+            self.reader = None
+            self.frame = None
+        self.stats = {'frames': 0, 'events': 0, 'dropped': 0, 'events_per_frame': 0.,
+                      'bytes_per_frame': 0., 'fps': 0.}
+
+    def _read(self):
+        """ events of the next frame"""
+        if self.reader is not None:
+            frame, seq = self.reader.get(timeout=0.1, out=self.frame)[:2]
+            self.stats['dropped'] = self.reader.dropped
+            return find_events(frame, self.threshold, self.offset, seq, self.min_pixels,
+                               camera_frames=True)
+        frame, seq = self.cam.acquire_frame(timeout=0.1)[:2]
+        try:  # the events are computed directly in the buffer of the SDK
+            return find_events(frame, self.threshold, self.offset, seq, self.min_pixels,
+                               camera_frames=True)
+        finally:
+            self.cam.release_frame(seq)
+
+    def _write_chunk(self, f, chunk):
+        events = np.concatenate(chunk)
+        f.write(events.data)
+        total = self.stats['events'] + events.size
+        end = f.tell()
+        f.seek(0)
+        f.write(npy_header((total,), EVENT_DTYPE, HEADER_SIZE))
+        f.seek(end)
+        f.flush()
+        self.stats['events'] = total
+        self.stats['events_per_frame'] = total / self.stats['frames']
+        self.stats['bytes_per_frame'] = self.stats['events_per_frame'] * EVENT_DTYPE.itemsize
+
+    def run(self):
+        t_start = time.perf_counter()
+        with open(self.path, 'wb') as f:
+            f.write(npy_header((0,), EVENT_DTYPE, HEADER_SIZE))
+            chunk = []
+            while not self._stop_event.is_set():
+                if self.max_frames is not None and self.stats['frames'] >= self.max_frames:
+                    break
+                try:
+                    chunk.append(self._read())
+                except Empty:
+                    continue
+                self.stats['frames'] += 1
+                if len(chunk) == self.chunk_frames:
+                    self._write_chunk(f, chunk)
+                    chunk = []
+                    self.stats['fps'] = self.stats['frames'] / (time.perf_counter() - t_start)
+            if chunk:
+                self._write_chunk(f, chunk)
+        print("event recording done:", self.stats)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+if __name__ == '__main__':
+    # Records the events of the frames of the camera without the GUI:
+    # python centroiding.py path n_frames threshold [offset] [--simulate]
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    path, n_frames, threshold = args[0], int(args[1]), int(args[2])
+    offset = int(args[3]) if len(args) > 3 else 0
+    if '--simulate' in sys.argv:
+        from pco_simulator import SimulatedPCOEdge
+        cam = SimulatedPCOEdge()
+    else:
+        from pco_definitions import PCOEdge
+        cam = PCOEdge()
+    if cam.open_camera() != 0:
+        sys.exit(1)
+    cam.arm_camera()
+    cam.allocate_buffer()
+    cam.start_recording()
+    cam._prepare_to_record_to_memory(grab_bool=True)
+    recorder = EventRecorder(cam, path, threshold, offset, max_frames=n_frames)
+    acquisition = Thread(target=cam.record_live, daemon=True)
+    acquisition.start()
+    recorder.start()
+    recorder.join()
+    cam.live = False
+    acquisition.join()
+    cam.disarm_camera()
+    cam.close_camera()
+    events = np.load(recorder.path, mmap_mode='r')
+    print(events.shape[0], "events in", recorder.path)
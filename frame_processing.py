@@ -0,0 +1,197 @@
+""" This file defines the FrameProcessor class, which prepares the live frames for the
+display in one pass: orientation (transpose and flip, as done in the GUI), threshold
+(if signal <= cor1, signal = 0, else signal -= cor0), background subtraction and the
+statistics of the result (min, max, mean and optionally a histogram).
+
+The result is written in a buffer allocated once (uint16, or int32 when a background
+is subtracted, to keep the negative values, or float32 when the background is a float
+array, e.g. the one of a BackgroundModel, which is then used without any copy).
+If numba is installed the processing is a single compiled loop over the pixels, parallel over tiles of the image (the tiles
+make both the reads of the frame and the writes of its transpose cache friendly).
+Otherwise numpy functions writing in preallocated buffers are used (a few passes
+over the image, but no allocation).
+
+downsample reduces an image to the resolution at which it is displayed.
+"""
+
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HIST_BINS = 256
+TILE = 32  # number of columns of the frame (rows of the result) per tile
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _process_kernel(frame, out, threshold, cor0, cor1, bkg, use_bkg,
+                        hist_offset, hist_shift, tile_stats, tile_hist):
+        """ out[c, H-1-r] = processed frame[r, c], stats per tile of TILE columns"""
+        H, W = frame.shape
+        n_tiles = (W + TILE - 1) // TILE
+        for t in numba.prange(n_tiles):
+            c0 = t * TILE
+            c1 = min(c0 + TILE, W)
+            v_min = np.inf
+            v_max = -np.inf
+            v_sum = 0.
+            for r in range(H):
+                for c in range(c0, c1):
+                    v = np.int64(frame[r, c])
+                    if threshold:
+                        if v <= cor1:
+                            v = 0
+                        else:
+                            v -= cor0
+                    if use_bkg:
+                        out[c, H - 1 - r] = v - bkg[c, H - 1 - r]
+                    else:
+                        out[c, H - 1 - r] = v
+                    x = np.float64(out[c, H - 1 - r])  # value after the cast to the dtype of out
+                    v_min = min(v_min, x)
+                    v_max = max(v_max, x)
+                    v_sum += x
+                    if hist_shift >= 0:
+                        b = (np.int64(np.floor(x)) + hist_offset) >> hist_shift
+                        tile_hist[t, min(max(b, 0), HIST_BINS - 1)] += 1
+            tile_stats[t, 0] = v_min
+            tile_stats[t, 1] = v_max
+            tile_stats[t, 2] = v_sum
+
+
+def oriented_copy(frame, out, tile=64):
+    """ out = frame.T[:, ::-1] (orientation of the GUI), copied by square tiles
+    which is about twice as fast as a single strided copy for large frames"""
+    H, W = frame.shape
+    for c in range(0, W, tile):
+        for r in range(0, H, tile):
+            np.copyto(out[c:c + tile, max(H - r - tile, 0):H - r],
+                      frame[r:r + tile, c:c + tile].T[:, ::-1], casting='unsafe')
+    return out
+
+
+def downsample(image, factor, mode='max'):
+    """ image reduced by factor in both directions: each pixel is the maximum (so
+    that isolated photon hits stay visible) or the mean of a block of factor x factor
+    pixels. The last rows and columns which do not fill a block are dropped.
+    The blocks are accumulated by strided slices, which is much faster than a
+    reshape followed by a reduction over two axes"""
+    if factor <= 1:
+        return image
+    h, w = image.shape[0] // factor * factor, image.shape[1] // factor * factor
+    if mode == 'max':
+        out = image[0:h:factor, 0:w:factor].copy()
+        for i in range(factor):
+            for j in range(factor):
+                if i or j:
+                    np.maximum(out, image[i:h:factor, j:w:factor], out=out)
+        return out
+    if mode == 'mean':
+        out = image[0:h:factor, 0:w:factor].astype(np.float32)
+        for i in range(factor):
+            for j in range(factor):
+                if i or j:
+                    np.add(out, image[i:h:factor, j:w:factor], out=out)
+        out /= factor * factor
+        return out
+    raise ValueError('Unknown downsampling mode: ' + mode)
+
+
+class FrameProcessor(object):
+    """
+    Preprocessing of the frames of the camera for the display.
+
+    Parameters
+    ----------
+    histogram : bool
+        also computes a histogram (HIST_BINS bins covering the whole range of values)
+    use_numba : bool or None
+        use the compiled kernel (None: if numba is installed)
+    """
+    def __init__(self, histogram=False, use_numba=None):
+        self.histogram = histogram
+        self.use_numba = (numba is not None) if use_numba is None else use_numba
+        if self.use_numba and numba is None:
+            raise ImportError('numba is not installed')
+        self.out = None
+        self.stats = {}
+        self._mask = None
+        self._bkg_source = None
+        self._bkg = np.zeros((1, 1), dtype=np.int32)
+
+    def _prepare(self, frame, bkg):
+        shape = frame.shape[::-1]
+        if bkg is None:
+            dtype = np.uint16
+        elif bkg.dtype.kind == 'f':
+            dtype = np.float32
+        else:
+            dtype = np.int32
+        if self.out is None or self.out.shape != shape or self.out.dtype != dtype:
+            self.out = np.empty(shape, dtype=dtype)
+            self._mask = np.empty(shape, dtype=bool)
+        if bkg is not None and bkg is not self._bkg_source:
+            if bkg.shape != shape:
+                raise ValueError('Incorrect background shape')
+            self._bkg = np.ascontiguousarray(bkg, dtype=dtype)  # no copy for a float32 background
+            self._bkg_source = bkg
+
+    def process(self, frame, cor=None, bkg=None):
+        """
+        Processes a frame of the camera (in the orientation of the camera).
+
+        Parameters
+        ----------
+        frame : 2D np.array
+        cor : (cor0, cor1) or None
+            threshold: if signal <= cor1, signal = 0, if signal > cor1, signal -= cor0
+        bkg : 2D np.array or None
+            background to subtract, in the orientation of the result (like the
+            images displayed by the GUI). An integer background is converted to int32
+            once (it must not be modified in place afterwards), a float32 background
+            is used as is, so it can be updated in place between the calls
+
+        Returns
+        -------
+        out : 2D np.array
+            the processed frame, in a buffer which is overwritten at the next call.
+            The statistics are in self.stats
+        """
+        self._prepare(frame, bkg)
+        out = self.out
+        if out.dtype == np.uint16:
+            hist_offset, hist_shift = 0, 16 - 8  # 256 bins over [0, 65536)
+        else:
+            hist_offset, hist_shift = 1 << 16, 17 - 8  # 256 bins over [-65536, 65536)
+        edges = (np.arange(HIST_BINS + 1) << hist_shift) - hist_offset
+
+        if self.use_numba:
+            n_tiles = (frame.shape[1] + TILE - 1) // TILE
+            tile_stats = np.empty((n_tiles, 3))
+            tile_hist = np.zeros((n_tiles if self.histogram else 1, HIST_BINS), dtype=np.int64)
+            cor0, cor1 = (0, 0) if cor is None else (int(cor[0]), int(cor[1]))
+            _process_kernel(frame, out, cor is not None, cor0, cor1, self._bkg, bkg is not None,
+                            hist_offset, hist_shift if self.histogram else -1, tile_stats, tile_hist)
+            self.stats = {'min': out.dtype.type(tile_stats[:, 0].min()),
+                          'max': out.dtype.type(tile_stats[:, 1].max()),
+                          'mean': tile_stats[:, 2].sum() / out.size}
+            if self.histogram:
+                self.stats['hist'], self.stats['hist_edges'] = tile_hist.sum(axis=0), edges
+            return out
+
+        oriented_copy(frame, out)
+        if cor is not None:
+            np.greater(out, cor[1], out=self._mask)
+            np.subtract(out, out.dtype.type(cor[0]), out=out)  # faster than with where=
+            np.multiply(out, self._mask, out=out)  # 0 where signal <= cor1
+        if bkg is not None:
+            np.subtract(out, self._bkg, out=out)
+        self.stats = {'min': out.min(), 'max': out.max(), 'mean': out.mean()}
+        if self.histogram:
+            values = np.floor(out) if out.dtype.kind == 'f' else out
+            values = np.right_shift(values.astype(np.int64) + hist_offset, hist_shift)
+            self.stats['hist'] = np.bincount(np.clip(values, 0, HIST_BINS - 1).ravel(),
+                                             minlength=HIST_BINS)
+            self.stats['hist_edges'] = edges
+        return out
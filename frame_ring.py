@@ -0,0 +1,152 @@
+""" This file defines the FrameRing class, a fixed-capacity ring of preallocated
+frames used to pass the live frames from the acquisition thread (PCOEdge.record_live)
+to the consumers (display, saving, Abel inversion,...).
+
+There is one producer. Each consumer reads through its own RingReader, so that a
+slow consumer (for example the saving) does not make a fast one (the display) miss
+frames. The frames are copied in and out of the slots without any lock: every slot
+holds a sequence number which is invalidated by the producer before writing and set
+again after, so a reader can detect that the slot was overwritten during its copy
+(seqlock). The producer never waits: when the ring is full, the oldest frame is
+overwritten and the readers which had not read it count it as dropped.
+"""
+
+import threading
+import time
+from queue import Empty
+import numpy as np
+
+
+class FrameRing(object):
+    """
+    Ring of capacity preallocated frames of the given shape and dtype.
+    Each slot carries the frame, its sequence number, its maximum and a timestamp.
+    """
+    def __init__(self, capacity, shape, dtype=np.uint16):
+        if capacity < 2:
+            raise ValueError('FrameRing capacity must be at least 2')
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frames = np.zeros((capacity,) + self.shape, dtype=self.dtype)
+        self.seq = np.full(capacity, -1, dtype=np.int64)  # -1: empty or being written
+        self.maxima = np.zeros(capacity, dtype=self.dtype)
+        self.timestamps = np.zeros(capacity)
+
+        self.write_seq = 0  # sequence number of the next frame written
+        self.frames_written = 0
+        # only used to sleep while waiting for a new frame, not to protect the data
+        self._new_frame = threading.Condition()
+        self._default_reader = RingReader(self)
+
+    def put(self, frame, timestamp=None, frame_max=None):
+        """ copies frame in the next slot (overwriting the oldest frame if needed)"""
+        seq = self.write_seq
+        slot = seq % self.capacity
+        self.seq[slot] = -1  # invalidates the slot for the readers
+        np.copyto(self.frames[slot], frame, casting='unsafe')
+        self.maxima[slot] = self.frames[slot].max() if frame_max is None else frame_max
+        self.timestamps[slot] = time.perf_counter() if timestamp is None else timestamp
+        self.seq[slot] = seq
+        self.write_seq = seq + 1
+        self.frames_written += 1
+        with self._new_frame:
+            self._new_frame.notify_all()
+
+    def reader(self):
+        """ creates a new reader, which starts with the next frame written"""
+        return RingReader(self)
+
+    def wait_for(self, seq, timeout=None):
+        """ waits until the frame seq has been written, returns False on timeout"""
+        if self.write_seq > seq:
+            return True
+        with self._new_frame:
+            return self._new_frame.wait_for(lambda: self.write_seq > seq, timeout)
+
+    def clear(self):
+        self.seq[:] = -1
+        self.write_seq = 0
+        self.frames_written = 0
+
+    # shortcuts using the default reader
+    def get(self, timeout=None, out=None):
+        return self._default_reader.get(timeout=timeout, out=out)
+
+    def latest(self, timeout=None, out=None):
+        return self._default_reader.latest(timeout=timeout, out=out)
+
+    @property
+    def dropped(self):
+        return self._default_reader.dropped
+
+
+class RingReader(object):
+    """
+    Reading cursor of a FrameRing. get() returns the frames in order, latest() the
+    newest one. Both return (frame, seq, frame_max, timestamp) and raise queue.Empty
+    if no new frame arrives within timeout.
+    If out is given, the frame is copied in it (and checked against a concurrent
+    overwrite), otherwise a view on the slot is returned, which stays valid until
+    the producer writes capacity more frames.
+    """
+    def __init__(self, ring):
+        self.ring = ring
+        self.read_seq = ring.write_seq  # next sequence number to read
+        self.dropped = 0  # frames overwritten before this reader could read them
+        self.skipped = 0  # frames passed over by latest()
+        self.torn = 0  # copies that had to be redone because the slot was overwritten
+
+    def _read(self, seq, out):
+        """ reads frame seq, returns None if it is not in the ring anymore"""
+        ring = self.ring
+        slot = seq % ring.capacity
+        while True:
+            if ring.seq[slot] != seq:
+                return None
+            frame_max, timestamp = ring.maxima[slot], ring.timestamps[slot]
+            if out is None:
+                frame = ring.frames[slot]
+            else:
+                np.copyto(out, ring.frames[slot])
+                frame = out
+            if ring.seq[slot] == seq:
+                return frame, seq, frame_max, timestamp
+            self.torn += 1
+
+    def _catch_up(self):
+        """ moves read_seq to the oldest frame still in the ring"""
+        oldest = self.ring.write_seq - self.ring.capacity
+        if self.read_seq < oldest:
+            self.dropped += oldest - self.read_seq
+            self.read_seq = oldest
+
+    def get(self, timeout=None, out=None):
+        """ next frame in order"""
+        while True:
+            if not self.ring.wait_for(self.read_seq, timeout):
+                raise Empty
+            self._catch_up()
+            result = self._read(self.read_seq, out)
+            if result is not None:
+                self.read_seq += 1
+                return result
+            self.read_seq += 1  # overwritten while reading
+            self.dropped += 1
+
+    def latest(self, timeout=None, out=None):
+        """ newest frame, the older unread frames are skipped"""
+        while True:
+            if not self.ring.wait_for(self.read_seq, timeout):
+                raise Empty
+            newest = self.ring.write_seq - 1
+            self.skipped += newest - self.read_seq
+            self.read_seq = newest
+            result = self._read(newest, out)
+            self.read_seq = newest + 1
+            if result is not None:
+                return result
+
+    def pending(self):
+        """ number of frames written and not read yet"""
+        return self.ring.write_seq - self.read_seq
@@ -9,9 +9,13 @@ import sys
 import numpy as np
 import traceback
 import matplotlib.pyplot as plt
-import time, queue
+import time
+import threading
+import collections
+from queue import Empty
 
 import sc2_SDKStructures as struct
+from frame_ring import FrameRing
 
 class PCOCAM_Exception(Exception):
     """Camera exceptions."""
@@ -25,10 +29,15 @@ class PCOEdge(object):
        PCOEdge class loads the SC2_Cam.dll in order to interface
        the basic functions of the pco.edge cmos detector.
        """
-    def __init__(self):
-        # Opening the dll
-        libname = os.path.abspath(os.path.join(os.path.dirname(__file__), "SC2_Cam.dll"))
-        self.libc = ctypes.CDLL(libname)
+    def __init__(self, libc=None):
+        """ libc is the object providing the SDK functions. By default it is the
+        SC2_Cam.dll library, but any object with the same PCO_... functions can be
+        used instead (see pco_simulator.py for a software camera)"""
+        if libc is None:
+            # Opening the dll
+            libname = os.path.abspath(os.path.join(os.path.dirname(__file__), "SC2_Cam.dll"))
+            libc = ctypes.CDLL(libname)
+        self.libc = libc
 
         self.iRet = ctypes.c_int()
         self.cam = struct.HANDLE()
@@ -46,14 +55,44 @@ class PCOEdge(object):
                            'binning': [1, 1],
                            'Exposure time': [0, '0'],
                            'Camera ROI dimensions': [0, 0]}
+        # ROI constraints of the pco.edge 4.2 (in pixels after binning): the horizontal
+        # limits are multiples of roi_steps[0], and the ROI must be symmetric around the
+        # horizontal axis of the sensor (roi_symmetric[1]) since the two halves of the
+        # sensor are read out from the center
+        self.roi_steps = [4, 1]
+        self.roi_symmetric = [False, True]
+        self.binning_values = [1, 2, 4]
         self.armed = False
         self.buffer_numbers = []
         self.buffer_pointers, self.buffer_events = (
             [], [])
+        self.buffer_size = 0  # size in bytes of each allocated buffer
+        self.buffer_time = 0.1  # s of frames that the buffers can hold when allocated from a frame rate
+        self.max_buffers = struct.PCO_BUFCNT  # the SDK handles at most 16 buffers per camera
+        self.exposure_ms = 10  # last exposure time read or set
         self.out = 0
-        # Queues that hold the data collected in the camera.
-        self.q = queue.Queue(maxsize=2)
-        self.q_m = queue.Queue(maxsize=2)
+        # How record_live waits for a buffer to be filled: see _wait_for_buffer
+        self.wait_modes = {'poll': "PCO_GetBufferStatus polling",
+                           'event': "buffer event (WaitForSingleObject)",
+                           'waitforbuffer': "PCO_WaitforBuffer"}
+        self.wait_strategy = 'event'
+        self.poll_interval = 0.05  # s, only used by the 'poll' strategy
+        self.wait_slice_ms = 100  # ms, maximum time spent in a single blocking wait
+        self.wait_timeout = 10  # s, without any frame
+        self.reset_latency_stats()
+        # Ring of preallocated frames that holds the data collected in the camera,
+        # (re)created for the current image size in _prepare_to_record_to_memory
+        self.ring = None
+        self.ring_capacity = 4
+        # How the frames leave the SDK buffers in record_live:
+        # 'copy': the frame is copied in self.ring before its buffer is given back to the camera
+        # 'pool': the SDK buffer itself is lent to the consumer (acquire_frame) and is only
+        #         given back to the camera after release_frame
+        self.handoff_modes = {'copy': "copy in the frame ring", 'pool': "SDK buffers lent to the consumer"}
+        self.handoff_mode = 'copy'
+        self.lend_timeout = 1  # s, a held buffer is taken back after this time if all buffers are lent
+        self._pool_cond = threading.Condition()
+        self.reset_handoff()
 
         """########################################################################"""
         """ Initialization of the C functions in the dll"""
@@ -105,6 +144,33 @@ class PCOEdge(object):
                                            ctypes.c_int]
         self.PCO_WaitforBuffer.restype = ctypes.c_int
 
+        self.PCO_SetROI = self.libc.PCO_SetROI
+        self.PCO_SetROI.argtypes = [struct.HANDLE, struct.WORD, struct.WORD, struct.WORD, struct.WORD]
+        self.PCO_SetROI.restype = ctypes.c_int
+
+        self.PCO_GetROI = self.libc.PCO_GetROI
+        self.PCO_GetROI.argtypes = [struct.HANDLE, ctypes.POINTER(struct.WORD), ctypes.POINTER(struct.WORD),
+                                    ctypes.POINTER(struct.WORD), ctypes.POINTER(struct.WORD)]
+        self.PCO_GetROI.restype = ctypes.c_int
+
+        self.PCO_SetBinning = self.libc.PCO_SetBinning
+        self.PCO_SetBinning.argtypes = [struct.HANDLE, struct.WORD, struct.WORD]
+        self.PCO_SetBinning.restype = ctypes.c_int
+
+        self.PCO_GetBinning = self.libc.PCO_GetBinning
+        self.PCO_GetBinning.argtypes = [struct.HANDLE, ctypes.POINTER(struct.WORD), ctypes.POINTER(struct.WORD)]
+        self.PCO_GetBinning.restype = ctypes.c_int
+
+        # used to wait on the buffer events (only on Windows, or if the backend has its own)
+        if hasattr(self.libc, 'WaitForSingleObject'):
+            self.WaitForSingleObject = self.libc.WaitForSingleObject
+        elif sys.platform == 'win32':
+            self.WaitForSingleObject = ctypes.windll.kernel32.WaitForSingleObject
+            self.WaitForSingleObject.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+            self.WaitForSingleObject.restype = ctypes.c_uint32
+        else:
+            self.WaitForSingleObject = None
+
         self.PCO_RemoveBuffer = self.libc.PCO_RemoveBuffer
         self.PCO_FreeBuffer = self.libc.PCO_FreeBuffer
         self.PCO_AllocateBuffer = self.libc.PCO_AllocateBuffer
@@ -129,6 +195,7 @@ class PCOEdge(object):
         return error
 
     def close_camera(self):
+        self.free_buffers()
         self.iRet = self.PCO_CloseCamera(self.cam)
         if (self.iRet != struct.PCO_NOERROR):
             print("Impossible to close camera")
@@ -145,6 +212,7 @@ class PCOEdge(object):
                                              ctypes.byref(wTimeBaseDelay), ctypes.byref(wTimeBaseExposure))
 
         print("Exposure time", dwExposure.value, "ms")
+        self.exposure_ms = dwExposure.value
         return dwExposure.value
 
     def set_exposure_time(self, exp_time):
@@ -154,12 +222,74 @@ class PCOEdge(object):
         wTimeBaseExposure = ctypes.c_uint16(2)  # 0 for ns, 1 for us and 2 for ms
         self.iRet = self.PCO_SetDelay_ExposureTime(self.cam, dwDelay, dwExposure, wTimeBaseDelay,
                                                    wTimeBaseExposure)
+        self.exposure_ms = exp_time
         return None
 
+    def set_binning(self, bin_h, bin_v):
+        """
+        Sets the binning used at the next arm_camera. The ROI is scaled to stay on
+        the same region of the sensor.
+        :return: the binning
+        """
+        if bin_h not in self.binning_values or bin_v not in self.binning_values:
+            raise ValueError('Binning must be one of ' + str(self.binning_values))
+        old_h, old_v = self.set_params['binning']
+        x0, y0, x1, y1 = self.set_params['ROI']
+        self.set_params['binning'] = [bin_h, bin_v]
+        self.set_roi((x0 - 1) * old_h // bin_h + 1, (y0 - 1) * old_v // bin_v + 1,
+                     x1 * old_h // bin_h, y1 * old_v // bin_v)
+        return self.set_params['binning']
+
+    def set_roi(self, x0, y0, x1, y1):
+        """
+        Sets the ROI used at the next arm_camera, in pixels after binning, starting at 1
+        (x1 and y1 included). The ROI is enlarged to satisfy the constraints of the
+        camera (steps and symmetry, see roi_steps and roi_symmetric).
+        :return: the ROI [x0, y0, x1, y1] that will be used
+        """
+        roi = [x0, y0, x1, y1]
+        sizes = [self.h_max // self.set_params['binning'][0],
+                 self.v_max // self.set_params['binning'][1]]
+        for axis in range(2):
+            size, step = sizes[axis], self.roi_steps[axis]
+            low, high = min(roi[axis], roi[axis + 2]), max(roi[axis], roi[axis + 2])
+            low, high = max(low, 1), min(high, size)
+            if self.roi_symmetric[axis]:
+                half = max(size // 2 - low + 1, high - size // 2)
+                low, high = size // 2 - half + 1, size // 2 + half
+            low = (low - 1) // step * step + 1
+            high = min(-(-high // step) * step, size)
+            if self.roi_symmetric[axis]:  # the step may have broken the symmetry
+                low = min(low, size - high + 1)
+                high = size - low + 1
+            roi[axis], roi[axis + 2] = low, high
+        self.set_params['ROI'] = roi
+        return roi
+
+    def set_centered_roi(self, width, height):
+        """ ROI of (at least) width x height pixels (after binning) around the center
+        of the sensor"""
+        sizes = [self.h_max // self.set_params['binning'][0],
+                 self.v_max // self.set_params['binning'][1]]
+        return self.set_roi(sizes[0] // 2 - width // 2 + 1, sizes[1] // 2 - height // 2 + 1,
+                            sizes[0] // 2 + (width + 1) // 2, sizes[1] // 2 + (height + 1) // 2)
+
+    def set_full_roi(self):
+        return self.set_roi(1, 1, self.h_max, self.v_max)
+
     def arm_camera(self):
         if self.armed:
             print('Camera already armed')
         else:
+            # sends the binning and the ROI (the ROI must fit in the binned sensor)
+            bin_h, bin_v = self.set_params['binning']
+            x0, y0, x1, y1 = self.set_params['ROI']
+            self.iRet = self.PCO_SetBinning(self.cam, bin_h, bin_v)
+            if self.iRet != struct.PCO_NOERROR:
+                print("Binning", bin_h, "x", bin_v, "refused by the camera, error", hex(self.iRet))
+            self.iRet = self.PCO_SetROI(self.cam, x0, y0, x1, y1)
+            if self.iRet != struct.PCO_NOERROR:
+                print("ROI", [x0, y0, x1, y1], "refused by the camera, error", hex(self.iRet))
             self.iRet = self.PCO_ArmCamera(self.cam)
 
             self.wXResAct, self.wYResAct, wXResMax, wYResMax = (
@@ -178,29 +308,73 @@ class PCOEdge(object):
         # set recording state to 0
         self.iRet = self.PCO_SetRecordingState(self.cam, 0)
 
-        # free all allocated buffers
-        #self.PCO_RemoveBuffer(self.cam)
-
-        """for buf in self.buffer_numbers:
-            self.PCO_FreeBuffer(self.cam, buf)""" # sometimes makes the program crash with mousemoved
-        # after stopping grabbing
+        # The buffers are kept allocated (and reused by allocate_buffer if the image size
+        # doesn't change), they are freed by free_buffers or close_camera.
+        # The buffers added to the driver queue were removed by PCO_CancelImages
+        if hasattr(self, '_prepared_to_record'):
+            del self._prepared_to_record
+        self.armed = False
 
+    def free_buffers(self):
+        """
+        Frees all the allocated buffers. The driver queue is emptied first
+        (PCO_CancelImages) so that no DMA transfer can still target them.
+        No numpy view on the buffers must be used after this call: record_single
+        and the 'copy' handoff mode only give copies, the frames lent in 'pool'
+        mode must have been released.
+        """
+        if self.buffer_numbers:
+            self.iRet = self.PCO_CancelImages(self.cam)
+            for buf in self.buffer_numbers:
+                self.PCO_FreeBuffer(self.cam, buf)
+        if hasattr(self, '_prepared_to_record'):
+            del self._prepared_to_record
         self.buffer_numbers, self.buffer_pointers, self.buffer_events = (
             [], [], [])
-        self.armed = False
+        self.buffer_size = 0
+
+    def num_buffers_for(self, target_fps=None):
+        """
+        Number of buffers needed to hold self.buffer_time seconds of frames at
+        target_fps (by default the frame rate allowed by the exposure time, at most
+        100 fps), between 2 and self.max_buffers.
+        """
+        if target_fps is None:
+            target_fps = min(100., 1000. / max(self.exposure_ms, 1))
+        return int(min(max(np.ceil(target_fps * self.buffer_time), 2), self.max_buffers))
 
-    def allocate_buffer(self, num_buffers=4):
+    def allocate_buffer(self, num_buffers=None, target_fps=None):
         """
-                Allocate buffers for image grabbing
-                :param num_buffers:
+                Allocate buffers for image grabbing, sized for the current image
+                (wXResAct x wYResAct, as given by arm_camera).
+                The existing buffers are reused if the image size is unchanged, and
+                freed first otherwise.
+                :param num_buffers: number of buffers (1 to self.max_buffers). If None it
+                is chosen from target_fps, see num_buffers_for
+                :param target_fps: expected frame rate
                 :return:
                 """
-        dwSize = ctypes.c_uint32(self.wXResAct.value * self.wYResAct.value * 2)  # 2 bytes per pixel
-        # set buffer variable to []
-        self.buffer_numbers, self.buffer_pointers, self.buffer_events = ([], [], [])
-        # now set buffer variables to correct value and pass them to the API
-
-        for i in range(num_buffers):
+        if num_buffers is None:
+            num_buffers = self.num_buffers_for(target_fps)
+        if not 1 <= num_buffers <= self.max_buffers:
+            raise ValueError('Number of buffers must be between 1 and ' + str(self.max_buffers))
+        size = self.wXResAct.value * self.wYResAct.value * 2  # 2 bytes per pixel
+        if size != self.buffer_size:
+            self.free_buffers()
+        elif num_buffers < len(self.buffer_numbers):
+            self.iRet = self.PCO_CancelImages(self.cam)
+            for buf in self.buffer_numbers[num_buffers:]:
+                self.PCO_FreeBuffer(self.cam, buf)
+            del self.buffer_numbers[num_buffers:]
+            del self.buffer_pointers[num_buffers:]
+            del self.buffer_events[num_buffers:]
+        if hasattr(self, '_prepared_to_record'):
+            del self._prepared_to_record
+        self.buffer_size = size
+        dwSize = ctypes.c_uint32(size)
+        # now set the new buffer variables to correct value and pass them to the API
+
+        for i in range(len(self.buffer_numbers), num_buffers):
             self.buffer_numbers.append(ctypes.c_int16(-1))
             self.buffer_pointers.append(ctypes.c_void_p(0))
             self.buffer_events.append(ctypes.c_void_p(0))
@@ -234,12 +408,178 @@ class PCOEdge(object):
         # prepare Python data types for receiving data
         # http://stackoverflow.com/questions/7543675/how-to-convert-pointer-to-c-array-to-python-array
         ArrayType = ctypes.c_uint16 * pixels_per_image.value
+        shape = (self.wYResAct.value, self.wXResAct.value)
+        if self.ring is None or self.ring.shape != shape or self.ring.capacity != self.ring_capacity:
+            self.ring = FrameRing(self.ring_capacity, shape, dtype=np.uint16)
         self._prepared_to_record = (dw1stImage, dwLastImage,
                                     wBitsPerPixel,
                                     dwStatusDll, dwStatusDrv,
                                     bytes_per_pixel, pixels_per_image,
                                     added_buffers, ArrayType)
 
+    def _wait_for_buffer(self, which_buf, dwStatusDll, dwStatusDrv):
+        """
+        Blocks until the buffer which_buf has been filled by the camera, using
+        the strategy in self.wait_strategy (see self.wait_modes):
+            'poll': PCO_GetBufferStatus every self.poll_interval seconds
+            'event': waits on the event handle returned by PCO_AllocateBuffer
+            'waitforbuffer': lets the SDK block in PCO_WaitforBuffer
+        The waits are done in slices of self.wait_slice_ms so that setting
+        self.live to False stops the acquisition quickly.
+        :param which_buf: index of the buffer in self.buffer_numbers
+        :param dwStatusDll, dwStatusDrv: c_uint32 updated with the buffer status
+        :return: True if the buffer is ready (detected at self.t_buffer_ready), False
+        if acquisition was stopped
+        """
+        t_start = time.perf_counter()
+        strategy = self.wait_strategy
+        if strategy == 'event' and self.WaitForSingleObject is None:
+            strategy = 'waitforbuffer'  # no kernel32 outside Windows
+        buflist = struct.PCO_Buflist()
+        buflist.sBufNr = self.buffer_numbers[which_buf].value
+
+        while self.live:
+            if strategy == 'poll':
+                self.PCO_GetBufferStatus(self.cam, self.buffer_numbers[which_buf],
+                                         ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
+                if dwStatusDll.value == 0xc0008000:
+                    self.t_buffer_ready = time.perf_counter()
+                    return True
+                time.sleep(self.poll_interval)
+            elif strategy == 'event':
+                ret = self.WaitForSingleObject(self.buffer_events[which_buf], self.wait_slice_ms)
+                if ret == 0:  # WAIT_OBJECT_0, the DMA transfer is done
+                    self.t_buffer_ready = time.perf_counter()
+                    self.PCO_GetBufferStatus(self.cam, self.buffer_numbers[which_buf],
+                                             ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
+                    return True
+            elif strategy == 'waitforbuffer':
+                self.PCO_WaitforBuffer(self.cam, 1, ctypes.byref(buflist), self.wait_slice_ms)
+                if buflist.dwStatusDll & 0x00008000:  # event set, buffer done
+                    self.t_buffer_ready = time.perf_counter()
+                    dwStatusDll.value = buflist.dwStatusDll
+                    dwStatusDrv.value = buflist.dwStatusDrv
+                    return True
+            else:
+                raise ValueError('Unknown wait strategy: ' + str(strategy))
+            if time.perf_counter() - t_start > self.wait_timeout:
+                print("After %i s, no buffer." % (self.wait_timeout))
+                raise TimeoutError
+        return False
+
+    def _update_interval(self, t_ready):
+        """ Updates the acquisition timing figures (in the acquisition thread):
+            'interval': time between two consecutive frames (exponential moving
+                        average, in s), and 'fps' its inverse"""
+        a = 0.1
+        stats = self.latency_stats
+        if stats['frames'] > 0:
+            interval = t_ready - stats['t_last']
+            if stats['interval'] == 0:
+                stats['interval'] = interval
+            else:
+                stats['interval'] += a * (interval - stats['interval'])
+            if stats['interval'] > 0:
+                stats['fps'] = 1 / stats['interval']
+        stats['t_last'] = t_ready
+        stats['frames'] += 1
+
+    def _update_latency(self, t_ready, t_handoff):
+        """ Updates the handoff latency (in the consumer thread, by acquire_frame):
+            'latency': time between the end of the DMA transfer being detected by
+                       the wait (t_ready) and the frame being handed to the
+                       consumer (exponential moving average, in s)
+        It includes the copy in the ring ('copy' mode) and the time the frame waited
+        for the consumer. For the 'poll' strategy the detection itself can lag the
+        end of the DMA transfer by up to self.poll_interval, which is not included."""
+        a = 0.1
+        stats = self.latency_stats
+        latency = t_handoff - t_ready
+        if stats['handed'] == 0:
+            stats['latency'] = latency
+        else:
+            stats['latency'] += a * (latency - stats['latency'])
+        stats['latency_max'] = max(stats['latency_max'], latency)
+        stats['handed'] += 1
+
+    def reset_latency_stats(self):
+        self.latency_stats = {'frames': 0, 'handed': 0, 'latency': 0., 'latency_max': 0.,
+                              'interval': 0., 'fps': 0., 't_last': 0.}
+        self.t_buffer_ready = 0.
+
+    def reset_handoff(self):
+        """ clears the lent buffers and the handoff counters:
+            'copied': frames copied in the ring ('copy' mode)
+            'lent': frames lent to the consumer ('pool' mode)
+            'dropped': lent frames taken back before the consumer acquired them
+            'starved': times the camera had no free buffer because all were lent
+            'torn': frames taken back while the consumer still held them, their
+                    content may have been overwritten by the camera"""
+        with self._pool_cond:
+            self._pool_ready = collections.deque()  # (frame, seq, max, timestamp, which_buf)
+            self._pool_held = {}  # seq -> which_buf, acquired and not released yet
+            self._pool_released = collections.deque()  # which_buf to give back to the camera
+            self._pool_seq = 0
+        self.handoff_stats = {'copied': 0, 'lent': 0, 'dropped': 0, 'starved': 0, 'torn': 0}
+
+    def acquire_frame(self, timeout=None):
+        """
+        Gets the next live frame, whatever the handoff mode.
+        :return: (frame, seq, frame_max, timestamp). In 'pool' mode, frame is the SDK
+        buffer itself and release_frame(seq) must be called when done with it. In
+        'copy' mode it is a slot of the ring (valid until the ring wraps around).
+        Raises queue.Empty if no frame arrives within timeout.
+        """
+        if self.handoff_mode == 'copy':
+            frame, seq, frame_max, timestamp = self.ring.get(timeout=timeout)
+        else:
+            with self._pool_cond:
+                if not self._pool_cond.wait_for(lambda: len(self._pool_ready) > 0, timeout):
+                    raise Empty
+                frame, seq, frame_max, timestamp, which_buf = self._pool_ready.popleft()
+                self._pool_held[seq] = which_buf
+        self._update_latency(timestamp, time.perf_counter())
+        return frame, seq, frame_max, timestamp
+
+    def release_frame(self, seq):
+        """ gives the buffer of frame seq back to the camera ('pool' mode)"""
+        if self.handoff_mode == 'copy':
+            return
+        with self._pool_cond:
+            which_buf = self._pool_held.pop(seq, None)
+            if which_buf is not None:  # otherwise it was already taken back (torn)
+                self._pool_released.append(which_buf)
+                self._pool_cond.notify_all()
+
+    def _lend_buffer(self, out, t_ready, which_buf):
+        """ puts the SDK buffer which_buf on the 'pool' queue"""
+        frame_max = out.max()  # full frame scan, outside the lock shared with the consumers
+        with self._pool_cond:
+            self._pool_ready.append((out, self._pool_seq, frame_max, t_ready, which_buf))
+            self._pool_seq += 1
+            self.handoff_stats['lent'] += 1
+            self._pool_cond.notify_all()
+
+    def _reclaim_buffers(self, added_buffers, readd):
+        """ 'pool' mode: gives the released buffers back to the camera. If every buffer
+        is lent, takes back the oldest frame not acquired yet or, after lend_timeout,
+        the oldest frame still held by the consumer"""
+        with self._pool_cond:
+            if not self._pool_released and not added_buffers:
+                self.handoff_stats['starved'] += 1
+                if self._pool_ready:
+                    self._pool_released.append(self._pool_ready.popleft()[-1])
+                    self.handoff_stats['dropped'] += 1
+                elif not self._pool_cond.wait_for(lambda: len(self._pool_released) > 0,
+                                                  self.lend_timeout) and self._pool_held:
+                    seq = min(self._pool_held)
+                    self._pool_released.append(self._pool_held.pop(seq))
+                    self.handoff_stats['torn'] += 1
+            released = list(self._pool_released)
+            self._pool_released.clear()
+        for which_buf in released:
+            readd(which_buf)
+
     def record_live(self):
         if not self.armed:
             raise UserWarning('Cannot record to memory with disarmed camera')
@@ -249,44 +589,43 @@ class PCOEdge(object):
 
         (dw1stImage, dwLastImage, wBitsPerPixel, dwStatusDll,
          dwStatusDrv, bytes_per_pixel, pixels_per_image, added_buffers, ArrayType) = self._prepared_to_record
-        poll_timeout = 5e5
         message = 0
         verbose = False
         self.live = True
+        self.reset_latency_stats()
+        self.reset_handoff()
+        pool = self.handoff_mode == 'pool'
         #out_preview = self.record_to_memory(1)[0]
 
-        t0 = time.clock()
+        def readd(which_buf):
+            self.PCO_AddBufferEx(  # Put the buffer back in the queue
+                self.cam, dw1stImage, dwLastImage,
+                self.buffer_numbers[which_buf], self.wXResAct, self.wYResAct,
+                wBitsPerPixel)
+            added_buffers.append(which_buf)
+
         while True:
             if not self.live:
                 break
-
-            num_polls = 0
-            polling = True
+            if pool:
+                self._reclaim_buffers(added_buffers, readd)
+                if not added_buffers:
+                    continue
 
             which_buf = added_buffers.pop(0)
+            lent = False
             try:
-                while polling:
-                    num_polls += 1
-                    message = self.PCO_GetBufferStatus(
-                        self.cam, self.buffer_numbers[which_buf],
-                        ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
-                    if dwStatusDll.value == 0xc0008000:
-                        # Buffer exits the queue
-                        if verbose:
-                            print("After", num_polls, "polls, buffer")
-                            print(self.buffer_numbers[which_buf].value)
-                            print("is ready.")
-                        polling = False
-                        t0 = time.clock()
-                        break
-                    else:
-                        time.sleep(0.05)  # Wait 5 milliseconds
-                    if num_polls > poll_timeout:
-                        print("After %i polls, no buffer." % (poll_timeout))
-                        raise TimeoutError
+                if not self._wait_for_buffer(which_buf, dwStatusDll, dwStatusDrv):
+                    added_buffers.insert(0, which_buf)  # stopped while waiting
+                    break
+                if verbose:
+                    print("Buffer", self.buffer_numbers[which_buf].value, "is ready.")
             except TimeoutError:
                 print('Timeout error')
-                pass
+                dwStatusDll.value = 0  # the status of the previous frame must not be reused
+                added_buffers.insert(0, which_buf)  # still queued at the camera, wait again
+                continue
+            t_ready = self.t_buffer_ready  # end of the DMA transfer, as seen by the wait
 
             try:
                 if dwStatusDrv.value == 0x00000000 and dwStatusDll.value == 0xc0008000:
@@ -302,27 +641,25 @@ class PCOEdge(object):
                     print(hex(dwStatusDll.value), hex(dwStatusDrv.value))
                     print(message)
                     print('Retrieving image from buffer ', which_buf)
-                self.ts = time.clock()
-                if self.q.full():
-                    self.q.queue.clear()
-                if self.q_m.full():
-                    self.q_m.queue.clear()
+                self.ts = t_ready
 
                 buffer_ptr = ctypes.cast(self.buffer_pointers[which_buf], ctypes.POINTER(ArrayType))
                 out = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape(
                     (self.wYResAct.value, self.wXResAct.value))
 
-                self.q_m.put(np.ndarray.max(out))
-                self.q.put(out)
+                if pool:
+                    self._lend_buffer(out, t_ready, which_buf)
+                    lent = True
+                else:
+                    self.ring.put(out, timestamp=t_ready)  # copy, the oldest frame is dropped if full
+                    self.handoff_stats['copied'] += 1
+                self._update_interval(t_ready)
 
             except UserWarning:
                 pass
             finally:
-                self.PCO_AddBufferEx(  # Put the buffer back in the queue
-                    self.cam, dw1stImage, dwLastImage,
-                    self.buffer_numbers[which_buf], self.wXResAct, self.wYResAct,
-                    wBitsPerPixel)
-                added_buffers.append(which_buf)
+                if not lent:  # a lent buffer goes back to the camera after release_frame
+                    readd(which_buf)
 
     def record_single(self):
         out = []
@@ -344,8 +681,9 @@ class PCOEdge(object):
                                       wBitsPerPixel)
 
         buffer_ptr = ctypes.cast(self.buffer_pointers[0], ctypes.POINTER(ArrayType))
+        # copy, so that the image stays valid when the buffer is reused or freed
         out = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape(
-                (self.wYResAct.value, self.wXResAct.value))
+                (self.wYResAct.value, self.wXResAct.value)).copy()
 
         #iRet = self.PCO_SetRecordingState(self.cam, 0)
         #iRet = self.PCO_FreeBuffer(self.cam, self.buffer_numbers[0]) # crashes if called
@@ -1,7 +1,7 @@
 from PyQt5.QtWidgets import QWidget, QLineEdit, QMainWindow, QApplication,\
     QGridLayout, QPushButton, QLabel, QFileDialog, QGroupBox, QComboBox, QCheckBox, \
     QProgressBar
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtCore import QTimer, Qt, QObject, pyqtSignal, QRectF
 from pco_definitions import PCOEdge
 from threading import Thread
 import os, time, sys, traceback
@@ -12,9 +12,13 @@ from queue import Empty
 from threading import Thread
 import threading
 import warnings
-from copy import deepcopy
 
 import abel_davis_class as abel
+from abel_cache import MatrixCache
+from frame_processing import FrameProcessor, downsample
+from background_model import BackgroundModel
+from abel_worker import AbelWorker
+from center_finding import CenterTracker
 
 """ GUI to display images from the PCO Edge Camera """
 """written by dplatzer"""
@@ -28,7 +32,11 @@ class CameraWidget(QWidget):
         QWidget.__init__(self, parent)
 
         self.default_path = 'Q:/LIDYL/Atto/ATTOLAB/SE1/'
-        self.cam = PCOEdge()
+        if '--simulate' in sys.argv:  # software camera, no SC2_Cam.dll needed
+            from pco_simulator import SimulatedPCOEdge
+            self.cam = SimulatedPCOEdge()
+        else:
+            self.cam = PCOEdge()
         self.available = True  # for the mouse_moved function
         self.image_available = False  # any data in self.im (loaded or recorded)?
         self.connected = False
@@ -40,9 +48,14 @@ class CameraWidget(QWidget):
         self.data = []
         self.exposure_time = 0
         self.im = []
-        self.bkg = []
-
-        self.image_view_thread = []
+        self.background = BackgroundModel()  # float32 background, built from one or several frames
+        self.accumulate_bkg_bool = False  # Do we add the frames to the background?
+
+        self.display_scheduler = None
+        self.display_fps = 20  # target frame rate of the live display
+        self.frame_processor = FrameProcessor()  # orientation, threshold, background and stats
+        self.display_binning = 'off'  # 'max' or 'mean': images reduced to the resolution of the view
+        self.rendering = False  # to ignore the view changes caused by render_image itself
         self.record_live_thread = []
 
         # for abel inversion
@@ -51,11 +64,27 @@ class CameraWidget(QWidget):
         self.dalpha = 1  # in degrees
         self.dr = 1
         self.N_photons = 1
+        self.R_max = None  # None: up to the nearest edge of the image
+        self.trunc_tol = None  # None: the matrices are not truncated
         self.abel_precalc_bool = False  # are the basis functions precalculated?
         self.with_abel_bool = False
+        self.accumulate_abel_bool = False  # live inversion of the mean of the images
         self.color_beta = [(255, 0, 0), (0, 255, 0), (0, 0, 255),
                            (255, 255, 0), (0, 255, 255)]
         self.abel_obj = []
+        self.precalc_th = None
+        self.abel_worker = None  # inverts the live images in its own thread
+        self.abel_F = None  # last result of abel_worker, plotted by the GUI
+        self.auto_center_bool = False  # is the center estimated on the live images?
+        self.center_tol = 0.5  # the center of the inversion is moved beyond this drift (pixels)
+        self.center_tracker = None
+        self.center_signals = CenterSignals()
+        self.center_signals.found.connect(self.center_found)
+        try:  # on-disk cache of the precalculated matrices
+            self.abel_cache = MatrixCache()
+        except OSError:
+            print('Abel matrix cache not available')
+            self.abel_cache = None
         self.levels_min = 0
         self.levels_max = 20000
 
@@ -122,6 +151,7 @@ class CameraWidget(QWidget):
         self.image_view.setColorMap(map)
 
         self.image_view.scene.sigMouseMoved.connect(self.mouse_moved)
+        self.image_view.view.sigRangeChanged.connect(self.view_range_changed)
         self.dock_direct_image.addWidget(self.image_view)
 
         # just for tests
@@ -137,6 +167,8 @@ class CameraWidget(QWidget):
         self.center_y_le = QLineEdit("")
         self.dalpha_le = QLineEdit("")  # in degrees
         self.dr_le = QLineEdit("")
+        self.R_max_le = QLineEdit("")  # empty: up to the nearest edge
+        self.trunc_tol_le = QLineEdit("")  # empty: no truncation
 
         self.N_photons_combo = QComboBox()
         self.N_phot_list = ['1', '2']
@@ -144,6 +176,10 @@ class CameraWidget(QWidget):
         self.N_photons_combo.currentIndexChanged.connect(self.set_n_photons_fn)
 
         self.with_abel_cb = QCheckBox("with abel")
+        self.accumulate_abel_cb = QCheckBox("accumulate")  # mean of the live images
+        self.auto_center_cb = QCheckBox("auto center")
+        self.center_lb = QLabel("")  # estimated center and drift
+        self.center_tol_le = QLineEdit(str(self.center_tol))
         self.precalculate_abel_btn = QPushButton("Precalculate")
 
         self.progress_precalc = QProgressBar()
@@ -157,8 +193,13 @@ class CameraWidget(QWidget):
         self.center_y_le.returnPressed.connect(self.update_center_y)
         self.dalpha_le.returnPressed.connect(self.update_dalpha)
         self.dr_le.returnPressed.connect(self.update_dr)
+        self.R_max_le.returnPressed.connect(self.update_R_max)
+        self.trunc_tol_le.returnPressed.connect(self.update_trunc_tol)
         self.precalculate_abel_btn.clicked.connect(self.precalculate_abel_fn)
         self.with_abel_cb.stateChanged.connect(self.with_abel_fn)
+        self.accumulate_abel_cb.stateChanged.connect(self.accumulate_abel_fn)
+        self.auto_center_cb.stateChanged.connect(self.auto_center_fn)
+        self.center_tol_le.returnPressed.connect(self.update_center_tol)
 
 
         self.abel_layout.addWidget(QLabel("center x"), 0, 0)
@@ -171,9 +212,18 @@ class CameraWidget(QWidget):
         self.abel_layout.addWidget(self.dr_le, 1, 3)
         self.abel_layout.addWidget(QLabel("N photons"), 2, 0)
         self.abel_layout.addWidget(self.N_photons_combo, 2, 1)
-        self.abel_layout.addWidget(self.with_abel_cb, 3, 0, 1, 2)
+        self.abel_layout.addWidget(QLabel("R max"), 2, 2)
+        self.abel_layout.addWidget(self.R_max_le, 2, 3)
+        self.abel_layout.addWidget(QLabel("trunc. tol"), 3, 2)
+        self.abel_layout.addWidget(self.trunc_tol_le, 3, 3)
+        self.abel_layout.addWidget(self.with_abel_cb, 3, 0)
+        self.abel_layout.addWidget(self.accumulate_abel_cb, 3, 1)
         self.abel_layout.addWidget(self.precalculate_abel_btn, 4, 0)
         self.abel_layout.addWidget(self.progress_precalc, 4, 1, 1, 3)
+        self.abel_layout.addWidget(self.auto_center_cb, 5, 0)
+        self.abel_layout.addWidget(self.center_lb, 5, 1)
+        self.abel_layout.addWidget(QLabel("center tol"), 5, 2)
+        self.abel_layout.addWidget(self.center_tol_le, 5, 3)
 
         self.dock_abel.addWidget(self.abel_layout)
 
@@ -189,6 +239,7 @@ class CameraWidget(QWidget):
         self.load_btn = QPushButton("Load")
         self.save_current_btn = QPushButton("Save current")
         self.exposure_le = QLineEdit()  # to set exposure time
+        self.display_fps_le = QLineEdit(str(self.display_fps))  # target fps of the live display
 
 
         self.noise_gb = QGroupBox(self)
@@ -218,17 +269,47 @@ class CameraWidget(QWidget):
         self.levels_min_le.returnPressed.connect(self.update_level_min)
         self.levels_max_le.returnPressed.connect(self.update_level_max)
 
+        self.display_binning_combo = QComboBox()
+        self.display_binning_list = ['off', 'max', 'mean']
+        self.display_binning_combo.addItems(self.display_binning_list)
+        self.display_binning_combo.currentIndexChanged.connect(self.set_display_binning_fn)
+
         self.levels_layout = QGridLayout()
         self.levels_layout.addWidget(self.levels_auto_cb, 0, 0, 1, 4)
         self.levels_layout.addWidget(QLabel("min"), 1, 0, 1, 1)
         self.levels_layout.addWidget(self.levels_min_le, 1, 1, 1, 1)
         self.levels_layout.addWidget(QLabel("max"), 1, 2, 1, 1)
         self.levels_layout.addWidget(self.levels_max_le, 1, 3, 1, 1)
+        self.levels_layout.addWidget(QLabel("Display binning"), 2, 0, 1, 2)
+        self.levels_layout.addWidget(self.display_binning_combo, 2, 2, 1, 2)
 
         self.levels_gb.setLayout(self.levels_layout)
 
+        self.roi_gb = QGroupBox()
+        self.roi_gb.setTitle("ROI / binning (camera pixels)")
+
+        self.binning_combo = QComboBox()
+        self.binning_combo.addItems([str(b) for b in self.cam.binning_values])
+        self.binning_combo.currentIndexChanged.connect(self.set_binning_fn)
+        self.roi_les = [QLineEdit(str(v)) for v in self.cam.set_params['ROI']]  # x0, y0, x1, y1
+        for le in self.roi_les:
+            le.returnPressed.connect(self.update_roi)
+        self.full_roi_btn = QPushButton("Full")
+        self.full_roi_btn.clicked.connect(self.full_roi_fn)
+
+        self.roi_layout = QGridLayout()
+        self.roi_layout.addWidget(QLabel("binning"), 0, 0, 1, 1)
+        self.roi_layout.addWidget(self.binning_combo, 0, 1, 1, 1)
+        self.roi_layout.addWidget(self.full_roi_btn, 0, 2, 1, 2)
+        for i, name in enumerate(["x0", "y0", "x1", "y1"]):
+            self.roi_layout.addWidget(QLabel(name), 1 + i // 2, 2 * (i % 2), 1, 1)
+            self.roi_layout.addWidget(self.roi_les[i], 1 + i // 2, 2 * (i % 2) + 1, 1, 1)
+
+        self.roi_gb.setLayout(self.roi_layout)
+
         self.coords_lb = QLabel("")  # gives x, y and value where the mouse is
         self.stat_lb = QLabel("")  # gives max and average of the image
+        self.fps_lb = QLabel("")  # gives displayed and acquired frame rates during live view
 
         self.grab_btn.setCheckable(True)
 
@@ -238,15 +319,17 @@ class CameraWidget(QWidget):
         self.load_btn.setFixedSize(80, 30)
         self.save_current_btn.setFixedSize(80, 30)
         self.exposure_le.setFixedSize(55, 20)
+        self.display_fps_le.setFixedSize(55, 20)
         self.coords_lb.setFixedSize(70, 50)
         self.stat_lb.setFixedSize(70, 30)
 
         self.open_camera_btn.clicked.connect(self.open_camera_btn_lr)
-        self.grab_btn.clicked[bool].connect(self.grab2_fn)
+        self.grab_btn.clicked[bool].connect(self.grab_fn)
         self.single_btn.clicked.connect(self.single_fn)
         self.load_btn.clicked.connect(self.load_fn)
         self.save_current_btn.clicked.connect(self.save_current_fn)
         self.exposure_le.returnPressed.connect(self.update_exposure)
+        self.display_fps_le.returnPressed.connect(self.update_display_fps)
 
         self.controls_layout.addWidget(self.open_camera_btn, 0, 0)
         self.controls_layout.addWidget(self.grab_btn, 1, 0)
@@ -258,13 +341,18 @@ class CameraWidget(QWidget):
 
         self.controls_layout.addWidget(self.noise_gb, 4, 0, 1, 2)
         self.controls_layout.addWidget(self.levels_gb, 5, 0, 1, 2)
+        self.controls_layout.addWidget(self.roi_gb, 6, 0, 1, 2)
+
+        self.controls_layout.addWidget(QLabel("Display fps"), 7, 0)
+        self.controls_layout.addWidget(self.display_fps_le, 7, 1)
 
         empty = QWidget()
         empty.setSizePolicy(1, 1)
-        self.controls_layout.addWidget(empty, 6, 0)
+        self.controls_layout.addWidget(empty, 8, 0)
 
-        self.controls_layout.addWidget(self.coords_lb, 7, 0)
-        self.controls_layout.addWidget(self.stat_lb, 7, 1)
+        self.controls_layout.addWidget(self.coords_lb, 9, 0)
+        self.controls_layout.addWidget(self.stat_lb, 9, 1)
+        self.controls_layout.addWidget(self.fps_lb, 10, 0, 1, 2)
 
         self.dock_control.addWidget(self.controls_layout)
 
@@ -272,6 +360,7 @@ class CameraWidget(QWidget):
         self.single_btn.setEnabled(False)
         self.save_current_btn.setEnabled(False)
         self.exposure_le.setEnabled(False)
+        self.roi_gb.setEnabled(False)
 
         self.set_noise_fn(0)
 
@@ -282,6 +371,13 @@ class CameraWidget(QWidget):
         else:
             self.with_abel_bool = False
 
+    def accumulate_abel_fn(self, state):
+        """ updates the "accumulate" QCheckBox (abel Dock): the live view shows the
+        inversion of the mean of the images since it was checked"""
+        self.accumulate_abel_bool = state == Qt.Checked
+        if self.abel_worker is not None:
+            self.abel_worker.set_accumulate(self.accumulate_abel_bool)
+
     def set_noise_fn(self, i):
         """ updates the noise treatment choice QComboBox.
         A change implies to remove all the widgets in the "Background Treatment"
@@ -290,6 +386,8 @@ class CameraWidget(QWidget):
             self.thresh_bool = False
         if self.substract_bool:
             self.substract_bool = False
+        if self.accumulate_bkg_bool:
+            self.accumulate_bkg_bool = False
 
         for widget in self.noise_gb.children():
             if isinstance(widget, QGridLayout):
@@ -321,19 +419,32 @@ class CameraWidget(QWidget):
             self.noise_layout.addWidget(lab, 4, 0, 1, 2)
 
         elif i == 2: # substraction
-            self.noise_gb.setFixedHeight(120)
+            self.noise_gb.setFixedHeight(190)
 
             self.set_current_bkg_btn = QPushButton("Set current as bkg")
-            if not self.image_available:
+            if not self.image_available or self.live_view_bool:
                 self.set_current_bkg_btn.setEnabled(False)
             self.set_current_bkg_btn.clicked.connect(self.set_current_bkg_fn)
+            self.bkg_mode_combo = QComboBox()
+            self.bkg_mode_combo.addItems(BackgroundModel.modes)
+            self.bkg_mode_combo.setCurrentIndex(BackgroundModel.modes.index(self.background.mode))
+            self.bkg_mode_combo.currentIndexChanged.connect(self.set_bkg_mode_fn)
+            self.accumulate_bkg_btn = QPushButton("Accumulate")
+            self.accumulate_bkg_btn.setCheckable(True)
+            self.accumulate_bkg_btn.clicked[bool].connect(self.accumulate_bkg_fn)
+            self.bkg_count_lb = QLabel()
+            self.update_bkg_count()
             self.substract_cb = QCheckBox()
             self.substract_cb.stateChanged.connect(self.update_substract_bool)
 
             self.noise_layout.addWidget(self.noise_combo, 0, 0, 1, 2)
             self.noise_layout.addWidget(self.set_current_bkg_btn, 1, 0, 1, 2)
-            self.noise_layout.addWidget(QLabel("On/Off"), 2, 0)
-            self.noise_layout.addWidget(self.substract_cb, 2, 1)
+            self.noise_layout.addWidget(QLabel("Mode"), 2, 0)
+            self.noise_layout.addWidget(self.bkg_mode_combo, 2, 1)
+            self.noise_layout.addWidget(self.accumulate_bkg_btn, 3, 0)
+            self.noise_layout.addWidget(self.bkg_count_lb, 3, 1)
+            self.noise_layout.addWidget(QLabel("On/Off"), 4, 0)
+            self.noise_layout.addWidget(self.substract_cb, 4, 1)
 
     def set_n_photons_fn(self, i):
         """ updates the "N photons" QComboBox. A change implies to add or remove figures
@@ -417,33 +528,110 @@ class CameraWidget(QWidget):
         except ValueError:
             print("Incorrect value for cor1, put back to previous value")
 
+    def show_roi(self):
+        for le, v in zip(self.roi_les, self.cam.set_params['ROI']):
+            le.setText(str(v))
+
+    def roi_changed(self):
+        """ the image size changes, so the abel precalculation is not valid anymore"""
+        if self.abel_precalc_bool:
+            self.abel_precalc_bool = False
+            self.precalculate_abel_btn.setEnabled(True)
+            if self.with_abel_cb.isChecked():
+                self.with_abel_cb.toggle()
+            self.with_abel_cb.setEnabled(False)
+
+    def update_roi(self):
+        """ updates the x0, y0, x1, y1 LineEdits ("ROI / binning" groupbox). The ROI
+        is adapted to the constraints of the camera and sent at the next acquisition"""
+        try:
+            roi = [int(le.text()) for le in self.roi_les]
+            self.cam.set_roi(*roi)
+            self.roi_changed()
+        except ValueError:
+            print("Incorrect value for the ROI, put back to previous value")
+        self.show_roi()
+
+    def full_roi_fn(self):
+        self.cam.set_full_roi()
+        self.roi_changed()
+        self.show_roi()
+
+    def set_binning_fn(self, i):
+        """ updates the binning QComboBox ("ROI / binning" groupbox)"""
+        b = self.cam.binning_values[i]
+        self.cam.set_binning(b, b)
+        self.roi_changed()
+        self.show_roi()
+
     def update_center_x(self):
         """ updates the "center x" LineEdit (abel dock)"""
         try:
-            self.center_x = int(self.center_x_le.text())
-            if self.abel_precalc_bool:
-                self.abel_precalc_bool = False
-                self.precalculate_abel_btn.setEnabled(True)
-                if self.with_abel_cb.isChecked():
-                    self.with_abel_cb.toggle()
-                self.with_abel_cb.setEnabled(False)
+            center = float(self.center_x_le.text())
         except ValueError:
             print("Incorrect value for center x, put back to previous value")
             self.center_x_le.setText(str(self.center_x))
+            return
+        self.set_center(center, self.center_y)
 
     def update_center_y(self):
         """ updates the "center y" LineEdit (abel dock)"""
         try:
-            self.center_y = int(self.center_y_le.text())
-            if self.abel_precalc_bool:
-                self.abel_precalc_bool = False
-                self.precalculate_abel_btn.setEnabled(True)
-                if self.with_abel_cb.isChecked():
-                    self.with_abel_cb.toggle()
-                self.with_abel_cb.setEnabled(False)
+            center = float(self.center_y_le.text())
         except ValueError:
             print("Incorrect value for center y, put back to previous value")
             self.center_y_le.setText(str(self.center_y))
+            return
+        self.set_center(self.center_x, center)
+
+    def set_center(self, center_x, center_y):
+        """ new center of the Abel inversion. The matrices do not depend on the
+        center: if they are precalculated only the polar plan is rebuilt"""
+        self.center_x = center_x
+        self.center_y = center_y
+        self.center_x_le.setText(str(center_x))
+        self.center_y_le.setText(str(center_y))
+        if self.center_tracker is not None:
+            self.center_tracker.set_reference((center_x, center_y))
+        if self.abel_precalc_bool:
+            self.stop_abel_worker()  # its buffers have the shape of the previous plan
+            self.abel_obj.set_center(center_x, center_y)
+        # during a precalculation, the new center is applied by precalc_finished
+
+    def auto_center_fn(self, state):
+        """ updates the "auto center" QCheckBox (abel dock): the center is estimated
+        on the accumulated live images, and moved when it drifts by more than
+        "center tol" pixels"""
+        self.auto_center_bool = state == Qt.Checked
+        if not self.auto_center_bool:
+            self.stop_center_tracker()
+
+    def update_center_tol(self):
+        """ updates the "center tol" LineEdit (abel dock)"""
+        try:
+            self.center_tol = float(self.center_tol_le.text())
+        except ValueError:
+            print("Incorrect value for center tol, put back to previous value")
+            self.center_tol_le.setText(str(self.center_tol))
+
+    def submit_center(self, im):
+        """ gives a live image to the center tracker, started at the first image"""
+        if self.center_tracker is None:
+            self.center_tracker = CenterTracker((self.center_x, self.center_y),
+                                                callback=self.center_signals.emit_found)
+            self.center_tracker.start()
+        self.center_tracker.submit(im)
+
+    def center_found(self, center_x, center_y, drift):
+        """ new estimate of the center tracker (in the GUI thread, through a signal)"""
+        self.center_lb.setText('({:.1f}, {:.1f})\ndrift {:.2f}'.format(center_x, center_y, drift))
+        if drift > self.center_tol:
+            self.set_center(round(center_x, 1), round(center_y, 1))
+
+    def stop_center_tracker(self):
+        if self.center_tracker is not None:
+            self.center_tracker.stop()
+            self.center_tracker = None
 
     def update_dalpha(self):
         """ updates the "dalpha (deg)" LineEdit (abel dock)"""
@@ -473,16 +661,76 @@ class CameraWidget(QWidget):
             print("Incorrect value for dr, put back to previous value")
             self.dr_le.setText(str(self.dr))
 
+    def update_R_max(self):
+        """ updates the "R max" LineEdit (abel dock), empty for no limit"""
+        try:
+            text = self.R_max_le.text().strip()
+            self.R_max = float(text) if text else None
+            if self.abel_precalc_bool:
+                self.abel_precalc_bool = False
+                self.precalculate_abel_btn.setEnabled(True)
+                if self.with_abel_cb.isChecked():
+                    self.with_abel_cb.toggle()
+                self.with_abel_cb.setEnabled(False)
+        except ValueError:
+            print("Incorrect value for R max, put back to previous value")
+            self.R_max_le.setText('' if self.R_max is None else str(self.R_max))
+
+    def update_trunc_tol(self):
+        """ updates the "trunc. tol" LineEdit (abel dock), empty for no truncation.
+        See Abel_object.truncate"""
+        try:
+            text = self.trunc_tol_le.text().strip()
+            self.trunc_tol = float(text) if text else None
+            if self.abel_precalc_bool:
+                self.abel_precalc_bool = False
+                self.precalculate_abel_btn.setEnabled(True)
+                if self.with_abel_cb.isChecked():
+                    self.with_abel_cb.toggle()
+                self.with_abel_cb.setEnabled(False)
+        except ValueError:
+            print("Incorrect value for trunc. tol, put back to previous value")
+            self.trunc_tol_le.setText('' if self.trunc_tol is None else str(self.trunc_tol))
+
     def precalculate_abel_fn(self):
-        self.precalculate_abel_btn.setEnabled(False)
+        """ "Precalculate" button, which becomes "Cancel" during the precalculation"""
+        if self.precalc_th is not None and self.precalc_th.is_alive():
+            self.precalc_th.cancel()
+            self.precalculate_abel_btn.setEnabled(False)  # until the running matrices are done
+            return
         self.grab_btn.setEnabled(False)
-        self.precalculate_abel_btn.repaint()
-        self.abel_obj = abel.abel_object(data=self.im, center_x=self.center_x,
+        previous_abel_obj = self.abel_obj
+        self.abel_obj = abel.Abel_object(data=self.im, center_x=self.center_x,
                                          center_y=self.center_y, d_alpha_deg=self.dalpha,
-                                         dr=self.dr, N=self.N_photons, parent=self)
+                                         dr=self.dr, N=self.N_photons, parent=self,
+                                         cache=self.abel_cache, R_max=self.R_max)
+        if isinstance(previous_abel_obj, abel.Abel_object):  # only the new matrices are computed
+            self.abel_obj.reuse_matrices(previous_abel_obj)
         self.precalc_th = Precalculate_abel(parent=self)
+        self.precalc_th.signals.progress.connect(self.progress_precalc.setValue)
+        self.precalc_th.signals.finished.connect(self.precalc_finished)
+        # always in the thread: even when everything was in the cache or reused, the
+        # truncation of the matrices must not block the GUI
+        self.progress_precalc.setValue(100 if self.abel_obj.is_precalculated() else 0)
+        self.precalculate_abel_btn.setText("Cancel")
         self.precalc_th.start()
 
+    def precalc_finished(self, complete):
+        """ end of the precalculation (in the GUI thread, through a signal)"""
+        self.precalculate_abel_btn.setText("Precalculate")
+        self.stop_abel_worker()  # it uses the previous matrices
+        if complete:
+            # the center may have been changed (by hand or by the center tracker)
+            # during the precalculation
+            self.abel_obj.set_center(self.center_x, self.center_y)
+            self.abel_precalc_bool = True
+            self.precalculate_abel_btn.setEnabled(False)
+            self.with_abel_cb.setEnabled(True)
+        else:  # cancelled
+            self.precalculate_abel_btn.setEnabled(True)
+        if self.connected:
+            self.grab_btn.setEnabled(True)
+
     def abel_invert(self):
         self.abel_obj.set_data(self.im)
         self.abel_obj.invert()
@@ -490,6 +738,32 @@ class CameraWidget(QWidget):
         for i in range(0, 2*self.N_photons+1):
             self.beta_curve[i].setData(self.abel_obj.F[i])
 
+    def submit_abel(self, im):
+        """ gives a live image to the Abel worker, started at the first image.
+        The worker only inverts the newest image, so it never slows the live view"""
+        if self.abel_worker is None:
+            self.abel_worker = AbelWorker(self.abel_obj, solve_interval=1 / self.display_fps)
+            self.abel_worker.set_accumulate(self.accumulate_abel_bool)
+            self.abel_worker.start()
+        self.abel_worker.submit(im)
+
+    def show_abel_result(self):
+        """ plots the last result of the Abel worker, if there is a new one (called by
+        DisplayScheduler, in the GUI thread)"""
+        if self.abel_worker is None:
+            return
+        result = self.abel_worker.latest(out=self.abel_F)
+        if result is not None:
+            self.abel_F = result[0]
+            for i in range(0, 2*self.N_photons+1):
+                self.beta_curve[i].setData(self.abel_F[i])
+
+    def stop_abel_worker(self):
+        if self.abel_worker is not None:
+            self.abel_worker.stop()
+            self.abel_worker = None
+            self.abel_F = None
+
     def image_available_fn(self):
         if not self.image_available:
             self.image_available = True
@@ -500,7 +774,36 @@ class CameraWidget(QWidget):
                 self.set_current_bkg_btn.setEnabled(True)
 
     def set_current_bkg_fn(self):
-        self.bkg = deepcopy(self.im)
+        self.background.set(self.im)
+        self.update_bkg_count()
+
+    def set_bkg_mode_fn(self, i):
+        """ updates the background "Mode" QComboBox (the accumulation restarts)"""
+        self.background.set_mode(BackgroundModel.modes[i])
+        self.update_bkg_count()
+
+    def accumulate_bkg_fn(self, pressed):
+        """ "Accumulate" button: while it is checked, the frames of the camera (live
+        view or single images) are added to the background, which restarts from them"""
+        if pressed:
+            self.background.reset()
+            self.accumulate_bkg_bool = True
+        else:
+            self.accumulate_bkg_bool = False
+            self.background.update()  # median of the last frames
+        self.update_bkg_count()
+
+    def update_bkg_count(self):
+        if self.noise_combo.currentIndex() == 2:
+            self.bkg_count_lb.setText('%d frames' % self.background.n_frames)
+
+    def background_to_subtract(self, shape):
+        """ the background if it is subtracted and has the shape of the images (it
+        is lost when the ROI changes), else None"""
+        bkg = self.background.bkg
+        if self.substract_bool and bkg is not None and bkg.shape == shape:
+            return bkg
+        return None
 
     def open_camera_btn_lr(self):
         error = self.cam.open_camera()
@@ -510,13 +813,15 @@ class CameraWidget(QWidget):
             self.grab_btn.setEnabled(True)
             self.single_btn.setEnabled(True)
             self.exposure_le.setEnabled(True)
+            self.roi_gb.setEnabled(True)
 
             self.exposure_time = self.cam.get_exposure_time()
             self.exposure_le.setText(str(self.exposure_time))
 
     def update_exposure(self):
         if self.alive:
-            self.grab2_fn()  # stops grabbing
+            self.grab_btn.setChecked(False)
+            self.grab_fn(False)  # stops grabbing
         try:
             self.exposure_time = int(self.exposure_le.text())
             self.cam.set_exposure_time(self.exposure_time)  # changing exposure time (in ms)
@@ -524,13 +829,90 @@ class CameraWidget(QWidget):
         except ValueError:
             print('Incorrect exposure time value')
 
+    def set_display_binning_fn(self, i):
+        """ updates the "Display binning" QComboBox ("Color Levels" groupbox)"""
+        self.display_binning = self.display_binning_list[i]
+        self.view_range_changed()
+
+    def view_range_changed(self, *args):
+        """ zoom or pan: the visible region of a still image is rendered again, at
+        full resolution if the view is zoomed enough (during live view the next frame
+        is rendered with the new range anyway)"""
+        if self.rendering or self.display_scheduler is not None:
+            return
+        if self.display_binning != 'off' and self.image_available:
+            self.render_image(self.im)
+
+    def render_image(self, im):
+        """ displays im with the chosen color levels. With display binning, only the
+        visible part of im is given to the ImageItem, reduced (max or mean over blocks)
+        to about the number of screen pixels of the view, and placed with setRect"""
+        shown, rect = im, (0, 0, im.shape[0], im.shape[1])
+        view = self.image_view.view
+        if self.display_binning != 'off':
+            if any(view.autoRangeEnabled()):  # the view follows the image: everything is visible
+                x0, x1, y0, y1 = 0, im.shape[0], 0, im.shape[1]
+            else:
+                (x0, x1), (y0, y1) = view.viewRange()
+                x0, x1 = int(np.clip(np.floor(x0), 0, im.shape[0])), int(np.clip(np.ceil(x1), 0, im.shape[0]))
+                y0, y1 = int(np.clip(np.floor(y0), 0, im.shape[1])), int(np.clip(np.ceil(y1), 0, im.shape[1]))
+            if x1 > x0 and y1 > y0:
+                factor = max(1, int(min((x1 - x0) / max(view.width(), 1),
+                                        (y1 - y0) / max(view.height(), 1))))
+                shown = downsample(im[x0:x1, y0:y1], factor, self.display_binning)
+                rect = (x0, y0, shown.shape[0] * factor, shown.shape[1] * factor)
+        self.rendering = True
+        try:
+            if not self.levels_auto_cb.isChecked():
+                self.image_view.setLevels(self.levels_min, self.levels_max)
+                self.image.setImage(shown, autoLevels=False, levels=(self.levels_min, self.levels_max))
+            else:
+                self.image.setImage(shown)
+            self.image.setRect(QRectF(*rect))
+        finally:
+            self.rendering = False
+
+    def update_display_fps(self):
+        """ updates the "Display fps" LineEdit, also during live view"""
+        try:
+            self.display_fps = float(self.display_fps_le.text())
+            if self.display_fps <= 0:
+                raise ValueError
+            if self.display_scheduler is not None:
+                self.display_scheduler.set_target_fps(self.display_fps)
+        except ValueError:
+            print("Incorrect value for display fps, put back to previous value")
+            self.display_fps_le.setText(str(self.display_fps))
+
+    def show_live_frame(self, frame):
+        """ displays a frame of the live view (called by DisplayScheduler, in the GUI
+        thread). The frame is put in the right direction, thresholded and the background
+        is subtracted (in float32 to have also negative values) in one pass. When the
+        background is accumulated, the raw frame is added to it first"""
+        if self.accumulate_bkg_bool:
+            self.background.add(frame.T[:, ::-1])
+            self.update_bkg_count()
+        im = self.frame_processor.process(frame, cor=self.cor if self.thresh_bool else None,
+                                          bkg=self.background_to_subtract(frame.shape[::-1]))
+        self.im = im
+        self.render_image(im)
+        stats = self.frame_processor.stats  # computed during the processing
+        self.stat_lb.setText('max = {:}\navg = {:}'.format(int(stats['max']),
+                                                            int(np.around(stats['mean']))))
+        if self.with_abel_bool and self.abel_precalc_bool:
+            self.submit_abel(im)
+        if self.auto_center_bool:
+            self.submit_center(im)
+
     def mouse_moved(self, view_pos):
         if self.available and not self.live_view_bool:
             self.available = False
             try:
                 data = self.im
                 n_rows, n_cols = data.shape
-                scene_pos = self.image_view.getImageItem().mapFromScene(view_pos)
+                # coordinates of the view = indices of self.im, even if a binned or
+                # partial image is displayed (see render_image)
+                scene_pos = self.image_view.view.mapSceneToView(view_pos)
 
                 row, col = int(scene_pos.x()), int(scene_pos.y())  # I inverted x and y
 
@@ -552,25 +934,24 @@ class CameraWidget(QWidget):
             self.load_btn.setEnabled(False)
             self.save_current_btn.setEnabled(False)
             self.exposure_le.setEnabled(False)
+            self.roi_gb.setEnabled(False)
             self.grab_btn.repaint()  # when forcing this button to repaint, the other widgets do as well
 
             self.single_thread = Thread(target=self.single_thread_callback)
             self.single_thread.setDaemon(True)
             self.single_thread.start()
             self.single_thread.join()
+            if self.accumulate_bkg_bool:
+                self.background.add(self.im)
+                self.update_bkg_count()
             if self.thresh_bool:
                 self.im[self.im <= self.cor[1]] = np.uint16(0)
                 self.im[self.im > self.cor[1]] -= self.cor[0]
-            if self.substract_bool:
-                self.im = np.int32(self.im) - np.int32(self.bkg) # to have also negative values,
+            bkg = self.background_to_subtract(self.im.shape)
+            if bkg is not None:
+                self.im = self.im - bkg  # float32, to have also negative values,
                 # otherwise -1 becomes 65535 in uint16 for example
-            if not self.levels_auto_cb.isChecked():
-                self.image_view.setLevels(self.levels_min, self.levels_max)
-                self.image.setImage(self.im, autoLevels=False,
-                                     levels=(self.levels_min, self.levels_max))
-            else:
-                self.image.setImage(self.im)
-            # self.image.setImage(self.im)  # doesn't work for exposure times >1000 ms
+            self.render_image(self.im)
             max_im = np.int32(self.im.max())
             # im3 = np.delete(im2, np.where(im2 == im2.max()))
             avg = np.int32(np.around(np.average(self.im)))
@@ -583,6 +964,7 @@ class CameraWidget(QWidget):
             self.grab_btn.setEnabled(True)
             self.load_btn.setEnabled(True)
             self.exposure_le.setEnabled(True)
+            self.roi_gb.setEnabled(True)
 
             self.image_available_fn()
 
@@ -592,46 +974,15 @@ class CameraWidget(QWidget):
     def single_thread_callback(self):
         self.cam.arm_camera() # Arm camera
         print('Camera armed')
-        self.cam.allocate_buffer(1)  # Allocate buffers, default = 4 buffers
+        self.cam.allocate_buffer(1)  # one buffer, kept allocated between acquisitions
         image = self.cam.record_single()
         self.im = image.T # putting the image in the right direction
         self.im = self.im[:, ::-1]
-        iRet = self.cam.PCO_SetRecordingState(self.cam.cam, 0)
-        self.cam.buffer_numbers, self.cam.buffer_pointers, self.cam.buffer_events = (
-            [], [], [])
-        self.cam.armed = False
-
-    def grab2_fn(self, pressed):
-        """ working quite well """
-        if pressed:
-            self.alive = True
-
-            self.single_btn.setEnabled(False)
-            self.load_btn.setEnabled(False)
-            self.save_current_btn.setEnabled(False)
-            self.exposure_le.setEnabled(False)
-            if self.noise_combo.currentIndex() == 2:
-                if self.set_current_bkg_btn.isEnabled():
-                    self.set_current_bkg_btn.setEnabled(False)
-
-            self.th = Grab(self)
-            self.th.start()
-        else:
-            self.alive = False
-            self.th.stop()
-
-            self.single_btn.setEnabled(True)
-            self.grab_btn.setEnabled(True)
-            self.load_btn.setEnabled(True)
-            self.exposure_le.setEnabled(True)
-            if self.noise_combo.currentIndex() == 2:
-                if not self.set_current_bkg_btn.isEnabled():
-                    self.set_current_bkg_btn.setEnabled(True)
-
-            self.image_available_fn()
+        self.cam.disarm_camera()  # the buffer is kept for the next acquisition
 
     def grab_fn(self, pressed):
-        """ Not working well and not used """
+        """ live view: the frames are acquired by cam.record_live in a thread and
+        displayed from the ring by a DisplayScheduler (GUI thread) """
         if self.connected:
             if pressed:
                 self.alive = True
@@ -639,13 +990,15 @@ class CameraWidget(QWidget):
                 self.load_btn.setEnabled(False)
                 self.save_current_btn.setEnabled(False)
                 self.exposure_le.setEnabled(False)
-                self.levels_min_le.setEnabled(False)
-                self.levels_max_le.setEnabled(False)
+                self.roi_gb.setEnabled(False)
+                if self.noise_combo.currentIndex() == 2:
+                    if self.set_current_bkg_btn.isEnabled():
+                        self.set_current_bkg_btn.setEnabled(False)
                 try:
                     self.cam.arm_camera()  # Arm camera
                     print('Camera armed')
                     self.cam.start_recording()  # Set recording status to 1
-                    self.cam.allocate_buffer(4)  # Allocate buffers, default = 4 buffers
+                    self.cam.allocate_buffer()  # Allocate buffers, number chosen from the frame rate
                     self.cam._prepare_to_record_to_memory(grab_bool=True)
 
                     self.record_live_thread = Thread(target=self.cam.record_live)
@@ -653,8 +1006,8 @@ class CameraWidget(QWidget):
                     self.record_live_thread.start()
                     print('acquisition started')
                     self.live_view_bool = True
-                    self.image_view_thread = ViewImage(self)
-                    self.image_view_thread.start()
+                    self.display_scheduler = DisplayScheduler(self, self.display_fps)
+                    self.display_scheduler.start()
                     print('view started')
                 except Exception:
                     print(traceback.format_exception(*sys.exc_info()))
@@ -665,8 +1018,10 @@ class CameraWidget(QWidget):
                 self.single_btn.setEnabled(True)
                 self.load_btn.setEnabled(True)
                 self.exposure_le.setEnabled(True)
-                self.levels_min_le.setEnabled(True)
-                self.levels_max_le.setEnabled(True)
+                self.roi_gb.setEnabled(True)
+                if self.noise_combo.currentIndex() == 2:
+                    if not self.set_current_bkg_btn.isEnabled():
+                        self.set_current_bkg_btn.setEnabled(True)
 
                 self.image_available_fn()
 
@@ -684,9 +1039,13 @@ class CameraWidget(QWidget):
             self.live_view_bool = False
             self.cam.live = False  # stop loop that is producing frames
 
-            self.image_view_thread.stop()
-            self.image_view_thread.join()
-            del self.image_view_thread
+            self.display_scheduler.stop()
+            if self.display_scheduler.displayed > 0:
+                self.im = np.array(self.im)  # the last displayed frame, not the processing buffer
+            self.display_scheduler = None
+            self.fps_lb.setText('')
+            self.stop_abel_worker()
+            self.stop_center_tracker()
 
             self.record_live_thread.join()
             del self.record_live_thread
@@ -703,7 +1062,7 @@ class CameraWidget(QWidget):
         else:
             try:
                 self.im = np.load(path)
-                self.image.setImage(self.im)
+                self.render_image(self.im)
                 self.image_available_fn()
             except Exception:
                 print(traceback.format_exception(*sys.exc_info()))
@@ -713,9 +1072,10 @@ class CameraWidget(QWidget):
         if path == "":
             print('saving aborted by user')
         else:
-            if self.substract_bool:
-                im = np.uint16(self.im + self.bkg)
-                bkg = np.uint16(self.bkg)
+            bkg = self.background_to_subtract(self.im.shape)
+            if bkg is not None:
+                im = np.uint16(np.around(self.im + bkg))
+                bkg = np.uint16(np.around(bkg))
                 print('Saving background')
                 save_thread = Save(path+"_bkg", bkg)
                 save_thread.start()
@@ -732,101 +1092,73 @@ class CameraWidget(QWidget):
             self.thresh_bool = False
 
 
-class Grab(Thread):
-    """This class is used for displaying single images recursively.
-    It goes with the grab2_fn function of the class above (CameraWidget)"""
-    def __init__(self, parent):
-        Thread.__init__(self)
-        self._stop_event = threading.Event()
+class DisplayScheduler(QObject):
+    """This class displays the frames stored in self.cam.ring by cam.record_live.
+    It goes with the grab_fn function of the class above (CameraWidget).
+    A QTimer calls update in the GUI thread at the target frame rate: only the newest
+    frame of the ring is taken (the older ones are skipped), so the display rate does
+    not depend on the camera rate, and a slow display never slows the acquisition.
+    The Abel inversion of the displayed images is done by an AbelWorker, whose
+    results are plotted by update as well."""
+    def __init__(self, parent, target_fps=20):
+        QObject.__init__(self)
         self.parent = parent
-        self.setDaemon(True)
-        self.exposure_time_s = self.parent.exposure_time / 1000
-        self.cor = self.parent.cor
-
-    def run(self):
-        self.parent.cam.arm_camera()  # Arm camera
-        print('Camera armed')
-        self.parent.cam.allocate_buffer(1)  # Allocate buffers, default = 4 buffers
-        while True:
-            if self._stop_event.is_set():
-                self.parent.cam.disarm_camera()
-                break
-            th = Thread(target=self.single_rec)
-            th.start()
-            th.join()
-            self.parent.im = self.parent.im.T  # putting the image in the right direction
-            self.parent.im = self.parent.im[:,::-1]
-            if self.parent.thresh_bool:
-                self.parent.im[self.parent.im <= self.cor[1]] = np.uint16(0)
-                self.parent.im[self.parent.im > self.cor[1]] -= self.cor[0]
-            if self.parent.substract_bool:
-                self.parent.im = np.int32(self.parent.im) - np.int32(self.parent.bkg)  # to have also negative values,
-                # otherwise -1 becomes 65535 in uint16 for example
-            if not self.parent.levels_auto_cb.isChecked():
-                self.parent.image_view.setLevels(self.parent.levels_min,
-                                                 self.parent.levels_max)
-                self.parent.image.setImage(self.parent.im, autoLevels=False,
-                                           levels=(self.parent.levels_min, self.parent.levels_max))
-            else:
-                self.parent.image.setImage(self.parent.im)
-            max_im = np.int32(self.parent.im.max())
-            # im3 = np.delete(im2, np.where(im2 == im2.max()))
-            avg = np.int32(np.around(np.average(self.parent.im)))
-            self.parent.stat_lb.setText('max = {:}\navg = {:}'.format(max_im, avg))
-            if self.parent.with_abel_bool and self.parent.abel_precalc_bool:
-                self.parent.abel_invert()
-            else:
-                time.sleep(max(0.5, self.exposure_time_s))
-
-    def single_rec(self):
-        self.parent.im = self.parent.cam.record_single()
+        ring = self.parent.cam.ring
+        self.reader = ring.reader()
+        self.frame = np.empty_like(ring.frames[0])
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.update)
+        self.set_target_fps(target_fps)
+        self.displayed = 0
+        self.stats = {'displayed_fps': 0., 'acquired_fps': 0.}
+        self._t_stats = time.perf_counter()
+        self._displayed_stats = 0
+        self._written_stats = ring.frames_written
+
+    def set_target_fps(self, fps):
+        self.timer.setInterval(int(round(1000 / fps)))
+
+    def start(self):
+        self.timer.start()
 
     def stop(self):
-        self._stop_event.set()
-
+        self.timer.stop()
 
-class ViewImage(Thread):
-    """Not used right now"""
-    """This class is used for displaying the images stored on self.cam.q
-    It goes with the grab_fn function of the class above (CameraWidget)"""
-    def __init__(self, parent):
-        Thread.__init__(self)
-        self._stop_event = threading.Event()
-        self.parent = parent
-        self.isRunning = False
-        self.setDaemon(True)
-        self.exposure_time_s = self.parent.exposure_time/1000
-
-    def run(self):
-        # time.sleep(max(self.exposure_time_s*3, 0.5))
-        corr1 = np.uint16(self.parent.cor[0])
-        corr2 = np.uint16(self.parent.cor[1])
-
-        while True:
-            if self._stop_event.is_set():
-                self.parent.im = deepcopy(im)
-                break
+    def update(self):
+        try:
+            frame = self.reader.latest(timeout=0, out=self.frame)[0]
+        except Empty:  # no new frame since the last update
+            frame = None
+        if frame is not None:
             try:
-
-                # get newest frame from queue. Transpose it so that is fits the coordinates convention
-                im = self.parent.cam.q.get().T
-                im = im[:,::-1]
-                if self.parent.thresh_bool:
-                    im[im <= corr2] = np.uint16(0)
-                    im[im > corr2] -= corr1
-                self.parent.image.setImage(im)
-                max_im = np.uint16(im.max())
-                avg = np.uint16(np.around(np.average(im)))
-                self.parent.stat_lb.setText('max = {:}\navg = {:}'.format(max_im, avg))
-                #self.parent.im = im
-
+                self.parent.show_live_frame(frame)
+                self.displayed += 1
             except Exception:
                 print(traceback.format_exception(*sys.exc_info()))
-
-            time.sleep(max(0.5, self.exposure_time_s))  # you can decrease 0.5, but the fps will stay low anyway
-
-    def stop(self):
-        self._stop_event.set()
+        try:
+            self.parent.show_abel_result()
+        except Exception:
+            print(traceback.format_exception(*sys.exc_info()))
+        self.update_stats()
+
+    def update_stats(self):
+        """ displayed and acquired frame rates, updated every second"""
+        t = time.perf_counter()
+        if t - self._t_stats < 1:
+            return
+        ring = self.parent.cam.ring
+        self.stats['displayed_fps'] = (self.displayed - self._displayed_stats) / (t - self._t_stats)
+        self.stats['acquired_fps'] = (ring.frames_written - self._written_stats) / (t - self._t_stats)
+        self._t_stats, self._displayed_stats, self._written_stats = t, self.displayed, ring.frames_written
+        text = 'display {:.1f} fps\ncamera {:.1f} fps'.format(self.stats['displayed_fps'],
+                                                             self.stats['acquired_fps'])
+        worker = self.parent.abel_worker
+        if worker is not None:  # latency from the submission of an image to its result
+            text += '\nabel {:.0f} ms, {:.0f}% skipped'.format(1000 * worker.stats['latency'],
+                                                               100 * worker.stats['skip_ratio'])
+            if worker.accumulating:
+                text += '\n{:d} images accumulated'.format(worker.stats['accumulated'])
+        self.parent.fps_lb.setText(text)
 
 
 class Save(Thread):
@@ -842,17 +1174,39 @@ class Save(Thread):
         print("image saved")
 
 
+class PrecalcSignals(QObject):
+    """ signals of Precalculate_abel, received in the GUI thread"""
+    progress = pyqtSignal(int)  # in %
+    finished = pyqtSignal(bool)  # False if cancelled
+
+
+class CenterSignals(QObject):
+    """ signal of CenterTracker (called in its thread), received in the GUI thread"""
+    found = pyqtSignal(float, float, float)  # center x, center y, drift
+
+    def emit_found(self, center, drift):
+        self.found.emit(center[0], center[1], drift)
+
+
 class Precalculate_abel(Thread):
     def __init__(self, parent=None):
-        Thread.__init__(self)
+        Thread.__init__(self, daemon=True)
         self.parent = parent
+        self.signals = PrecalcSignals()
+        self._cancel_event = threading.Event()
 
     def run(self):
-        self.parent.abel_obj.precalculate()
-        self.parent.abel_precalc_bool = True
-        self.parent.with_abel_cb.setEnabled(True)
-        if self.parent.connected:
-            self.parent.grab_btn.setEnabled(True)
+        complete = self.parent.abel_obj.precalculate(progress=self.progress,
+                                                     cancel=self._cancel_event)
+        if complete and self.parent.trunc_tol is not None:
+            self.parent.abel_obj.truncate(self.parent.trunc_tol)
+        self.signals.finished.emit(complete)
+
+    def progress(self, done, total):
+        self.signals.progress.emit(int(done / total * 100))
+
+    def cancel(self):
+        self._cancel_event.set()
 
 
 if __name__ == '__main__':
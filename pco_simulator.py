@@ -0,0 +1,389 @@
+""" This file defines a software camera that can replace the SC2_Cam.dll library.
+SimulatedSC2Cam implements the PCO_... functions used by the PCOEdge class, so that
+the acquisition code, the queues and the Abel inversion can be run and load-tested
+on a computer without the camera (or without Windows).
+
+Usage:
+    cam = SimulatedPCOEdge(max_fps=100, pattern='rings')
+or
+    cam = PCOEdge(libc=SimulatedSC2Cam())
+"""
+
+import ctypes
+import threading
+import time
+import collections
+from queue import Empty
+import numpy as np
+
+import sc2_SDKStructures as struct
+from pco_definitions import PCOEdge
+
+# buffer status values returned by PCO_GetBufferStatus (dwStatusDll)
+STATUS_ALLOCATED = 0x80000000
+STATUS_DONE = 0xc0008000  # allocated + event set
+WAIT_OBJECT_0 = 0x00000000
+WAIT_TIMEOUT = 0x00000102
+PCO_ERROR_TIMEOUT = 0x80000300
+PCO_ERROR_WRONGVALUE = 0x80000001
+
+
+def _value(arg):
+    """ value of an argument passed either as a python number or as a ctypes object"""
+    return getattr(arg, 'value', arg)
+
+
+def _obj(arg):
+    """ ctypes object behind a ctypes.byref() argument"""
+    return getattr(arg, '_obj', arg)
+
+
+class _SDKFunction(object):
+    """ Wraps a python method so that it looks like a function of a ctypes.CDLL
+    (PCOEdge sets the argtypes and restype attributes on every SDK function)"""
+    def __init__(self, function):
+        self.function = function
+        self.argtypes = None
+        self.restype = ctypes.c_int
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+
+class SimulatedSC2Cam(object):
+    """
+    Software pco.edge camera with the same function names as SC2_Cam.dll.
+
+    Frames are produced at 1/max(exposure, readout time) where the readout time
+    is 1/max_fps for the full sensor and scales with the number of rows of the
+    ROI. A frame is only written if a buffer is waiting in the queue (added with
+    PCO_AddBufferEx), otherwise it is counted in frames_lost, like on the camera.
+    The images are taken in a bank of n_bank precomputed noisy frames (generated
+    with the given seed) so that the production of a frame costs one copy and the
+    results are reproducible.
+
+    Parameters
+    ----------
+    width, height : int
+        sensor size in pixels
+    max_fps : float
+        frame rate of the full sensor when the exposure time is short enough
+    pattern : str
+        'rings' (VMI-like image), 'gradient' or 'zeros'
+    rings : list of (radius, width, amplitude, beta2)
+        rings of the 'rings' pattern, radius and width in pixels of the sensor
+    center : (x, y) or None
+        center of the rings (sensor pixels), the sensor center by default
+    offset : int
+        dark level of the camera
+    n_bank : int
+        number of different frames
+    seed : int
+        seed of the random generator
+    """
+    def __init__(self, width=2048, height=2048, max_fps=100., pattern='rings',
+                 rings=((300, 8, 40, 2.), (550, 12, 25, 0.5), (800, 10, 15, -0.8)),
+                 center=None, offset=100, n_bank=8, seed=0):
+        self.width = width
+        self.height = height
+        self.max_fps = max_fps
+        self.pattern = pattern
+        self.rings = rings
+        self.center = center if center is not None else ((width - 1) / 2, (height - 1) / 2)
+        self.offset = offset
+        self.n_bank = n_bank
+        self.seed = seed
+
+        self.lock = threading.RLock()
+        self.opened = False
+        self.recording_state = 0
+        self.buffers = {}  # buffer number -> dict with the memory and the status
+        self.queue = collections.deque()  # buffers added with PCO_AddBufferEx
+        self.frames_produced = 0
+        self.frames_lost = 0
+        self._bank = None
+        self._bank_key = None
+        self.reset_settings()
+
+        # makes every PCO_ method look like a dll function
+        for name in dir(type(self)):
+            if name.startswith('PCO_') or name == 'WaitForSingleObject':
+                setattr(self, name, _SDKFunction(getattr(self, name)))
+
+    def reset_settings(self):
+        self.delay = [0, 2]  # value, timebase (0 ns, 1 us, 2 ms)
+        self.exposure = [10, 2]
+        self.roi = [1, 1, self.width, self.height]
+        self.binning = [1, 1]
+
+    """########################################################################"""
+    """ Frame production """
+    def sizes(self):
+        x0, y0, x1, y1 = self.roi
+        return (x1 - x0 + 1), (y1 - y0 + 1)
+
+    def frame_period(self):
+        """ time between two frames (in s) for the current settings"""
+        exposure = self.exposure[0] * 10.**(3 * self.exposure[1] - 9)
+        rows = self.sizes()[1] * self.binning[1]
+        readout = rows / self.height / self.max_fps
+        return max(exposure, readout)
+
+    def _make_bank(self):
+        """ precomputes n_bank frames for the current ROI and binning"""
+        key = (tuple(self.roi), tuple(self.binning), self.pattern)
+        if key == self._bank_key:
+            return
+        w, h = self.sizes()
+        bh, bv = self.binning
+        rng = np.random.default_rng(self.seed)
+        # sensor coordinates of the center of each (binned) pixel
+        x = self.roi[0] - 1 + (np.arange(w) + 0.5) * bh - 0.5
+        y = self.roi[1] - 1 + (np.arange(h) + 0.5) * bv - 0.5
+        xx, yy = np.meshgrid(x - self.center[0], y - self.center[1])
+        if self.pattern == 'rings':
+            r = np.hypot(xx, yy)
+            cos_t = np.divide(yy, r, out=np.zeros_like(r), where=r > 0)
+            p2 = 0.5 * (3 * cos_t**2 - 1)
+            mean = np.zeros((h, w))
+            for radius, width, amplitude, beta2 in self.rings:
+                mean += amplitude * np.exp(-0.5 * ((r - radius) / width)**2) * (1 + beta2 * p2)
+            mean *= bh * bv
+            self._bank = np.empty((self.n_bank, h, w), dtype=np.uint16)
+            for i in range(self.n_bank):
+                self._bank[i] = np.clip(rng.poisson(mean) + self.offset, 0, 65535)
+        elif self.pattern == 'gradient':
+            base = (xx - xx.min() + yy - yy.min()).astype(np.uint16) + self.offset
+            self._bank = np.empty((self.n_bank, h, w), dtype=np.uint16)
+            for i in range(self.n_bank):
+                self._bank[i] = base + i
+        else:
+            self._bank = np.zeros((self.n_bank, h, w), dtype=np.uint16)
+        self._bank_key = key
+
+    def _fill(self, number):
+        """ writes the next frame in the buffer and sets its event"""
+        buf = self.buffers[number]
+        w, h = buf['size']
+        out = np.frombuffer(buf['memory'], dtype=np.uint16, count=w * h).reshape((h, w))
+        if out.shape == self._bank.shape[1:]:
+            out[:] = self._bank[self.frames_produced % self.n_bank]
+        else:
+            out[:] = 0
+        buf['status'] = STATUS_DONE
+        buf['event'].set()
+        self.frames_produced += 1
+
+    def _advance(self):
+        """ produces all the frames that should have been read out by now"""
+        with self.lock:
+            if self.recording_state != 1:
+                return
+            now = time.perf_counter()
+            while now >= self._next_time:
+                if self.queue:
+                    self._fill(self.queue.popleft())
+                    self._next_time += self._period
+                else:  # nobody to receive the frame(s)
+                    missed = int((now - self._next_time) / self._period) + 1
+                    self.frames_lost += missed
+                    self._next_time += missed * self._period
+
+    def _wait(self, number, timeout_ms):
+        """ waits until buffer number is done, returns False on timeout"""
+        deadline = time.perf_counter() + timeout_ms / 1000
+        while True:
+            self._advance()
+            buf = self.buffers.get(number)
+            if buf is None:
+                return False
+            if buf['status'] == STATUS_DONE:
+                return True
+            now = time.perf_counter()
+            if now >= deadline:
+                return False
+            wake = min(deadline, getattr(self, '_next_time', deadline))
+            time.sleep(max(wake - now, 0.0005))
+
+    """########################################################################"""
+    """ SC2_Cam.dll functions """
+    def PCO_OpenCamera(self, handle, wCamNum):
+        _obj(handle).value = 1
+        self.opened = True
+        return struct.PCO_NOERROR
+
+    def PCO_CloseCamera(self, handle):
+        self.opened = False
+        return struct.PCO_NOERROR
+
+    def PCO_GetRecordingState(self, handle, state):
+        _obj(state).value = self.recording_state
+        return struct.PCO_NOERROR
+
+    def PCO_SetRecordingState(self, handle, state):
+        with self.lock:
+            state = _value(state)
+            if state == 1 and self.recording_state != 1:
+                self._period = self.frame_period()
+                self._next_time = time.perf_counter() + self._period
+            self.recording_state = state
+        return struct.PCO_NOERROR
+
+    def PCO_ResetSettingsToDefault(self, handle):
+        self.reset_settings()
+        return struct.PCO_NOERROR
+
+    def PCO_ArmCamera(self, handle):
+        x0, y0, x1, y1 = self.roi
+        if not (1 <= x0 < x1 <= self.width // self.binning[0]
+                and 1 <= y0 < y1 <= self.height // self.binning[1]):
+            return PCO_ERROR_WRONGVALUE
+        self._make_bank()
+        return struct.PCO_NOERROR
+
+    def PCO_GetDelayExposureTime(self, handle, delay, exposure, tb_delay, tb_exposure):
+        _obj(delay).value, _obj(tb_delay).value = self.delay
+        _obj(exposure).value, _obj(tb_exposure).value = self.exposure
+        return struct.PCO_NOERROR
+
+    def PCO_SetDelayExposureTime(self, handle, delay, exposure, tb_delay, tb_exposure):
+        self.delay = [_value(delay), _value(tb_delay)]
+        self.exposure = [_value(exposure), _value(tb_exposure)]
+        return struct.PCO_NOERROR
+
+    def PCO_GetSizes(self, handle, x_act, y_act, x_max, y_max):
+        _obj(x_act).value, _obj(y_act).value = self.sizes()
+        _obj(x_max).value = self.width // self.binning[0]
+        _obj(y_max).value = self.height // self.binning[1]
+        return struct.PCO_NOERROR
+
+    def PCO_SetROI(self, handle, x0, y0, x1, y1):
+        self.roi = [_value(x0), _value(y0), _value(x1), _value(y1)]
+        return struct.PCO_NOERROR
+
+    def PCO_GetROI(self, handle, x0, y0, x1, y1):
+        _obj(x0).value, _obj(y0).value, _obj(x1).value, _obj(y1).value = self.roi
+        return struct.PCO_NOERROR
+
+    def PCO_SetBinning(self, handle, bin_h, bin_v):
+        self.binning = [_value(bin_h), _value(bin_v)]
+        return struct.PCO_NOERROR
+
+    def PCO_GetBinning(self, handle, bin_h, bin_v):
+        _obj(bin_h).value, _obj(bin_v).value = self.binning
+        return struct.PCO_NOERROR
+
+    def PCO_AllocateBuffer(self, handle, number, size, pointer, event):
+        with self.lock:
+            number = _obj(number)
+            if number.value == -1:
+                number.value = next(i for i in range(len(self.buffers) + 1) if i not in self.buffers)
+            memory = (ctypes.c_uint8 * _value(size))()
+            self.buffers[number.value] = {'memory': memory, 'size': self.sizes(),
+                                          'event': threading.Event(),
+                                          'status': STATUS_ALLOCATED}
+            _obj(pointer).value = ctypes.addressof(memory)
+            _obj(event).value = number.value + 1  # handle of the event (never 0)
+        return struct.PCO_NOERROR
+
+    def PCO_FreeBuffer(self, handle, number):
+        with self.lock:
+            number = _value(number)
+            if number in self.queue:
+                self.queue.remove(number)
+            self.buffers.pop(number, None)
+        return struct.PCO_NOERROR
+
+    def PCO_AddBufferEx(self, handle, first, last, number, x_act, y_act, bits):
+        with self.lock:
+            number = _value(number)
+            buf = self.buffers[number]
+            buf['size'] = (_value(x_act), _value(y_act))
+            buf['status'] = STATUS_ALLOCATED
+            buf['event'].clear()
+            self.queue.append(number)
+        return struct.PCO_NOERROR
+
+    def PCO_GetBufferStatus(self, handle, number, status_dll, status_drv):
+        self._advance()
+        _obj(status_dll).value = self.buffers[_value(number)]['status']
+        _obj(status_drv).value = struct.PCO_NOERROR
+        return struct.PCO_NOERROR
+
+    def PCO_WaitforBuffer(self, handle, count, buflist, timeout_ms):
+        buflist = _obj(buflist)
+        if self._wait(buflist.sBufNr, timeout_ms):
+            buflist.dwStatusDll = STATUS_DONE
+            buflist.dwStatusDrv = struct.PCO_NOERROR
+            return struct.PCO_NOERROR
+        return PCO_ERROR_TIMEOUT
+
+    def PCO_CancelImages(self, handle):
+        with self.lock:
+            self.queue.clear()
+        return struct.PCO_NOERROR
+
+    def PCO_RemoveBuffer(self, handle):
+        return self.PCO_CancelImages(handle)
+
+    def PCO_SetImageParameters(self, handle, x_act, y_act, flags, param, length):
+        return struct.PCO_NOERROR
+
+    def PCO_GetImageEx(self, handle, segment, first, last, number, x_act, y_act, bits):
+        """ single image: waits for one frame period and fills the buffer"""
+        with self.lock:
+            self._make_bank()
+            buf = self.buffers[_value(number)]
+            buf['size'] = (_value(x_act), _value(y_act))
+        time.sleep(self.frame_period())
+        with self.lock:
+            self._fill(_value(number))
+        return struct.PCO_NOERROR
+
+    def WaitForSingleObject(self, event, timeout_ms):
+        """ replaces kernel32.WaitForSingleObject for the buffer events"""
+        if self._wait(_value(event) - 1, timeout_ms):
+            return WAIT_OBJECT_0
+        return WAIT_TIMEOUT
+
+
+class SimulatedPCOEdge(PCOEdge):
+    """ PCOEdge class running on a SimulatedSC2Cam. The keyword arguments are
+    passed to SimulatedSC2Cam."""
+    def __init__(self, **kwargs):
+        PCOEdge.__init__(self, libc=SimulatedSC2Cam(**kwargs))
+
+
+if __name__ == '__main__':
+    # Load test: live acquisition during a few seconds with each wait strategy and handoff mode
+    duration = 3  # s
+    for strategy, mode in [('poll', 'copy'), ('event', 'copy'), ('waitforbuffer', 'copy'),
+                           ('event', 'pool')]:
+        cam = SimulatedPCOEdge(max_fps=100)
+        cam.wait_strategy = strategy
+        cam.handoff_mode = mode
+        cam.open_camera()
+        cam.set_exposure_time(1)
+        cam.arm_camera()
+        cam.allocate_buffer(target_fps=100)
+        cam.start_recording()
+        cam._prepare_to_record_to_memory(grab_bool=True)
+        th = threading.Thread(target=cam.record_live, daemon=True)
+        th.start()
+        n = 0
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < duration:
+            try:
+                frame, seq = cam.acquire_frame(timeout=1)[:2]
+                cam.release_frame(seq)
+                n += 1
+            except Empty:
+                pass
+        cam.live = False
+        th.join()
+        cam.disarm_camera()
+        stats = cam.latency_stats
+        print("{:14s} {:5s} {:6.1f} fps received, {:6.1f} fps acquired, latency {:.3f} ms (max {:.3f} ms),"
+              " {} frames lost, {} dropped in the ring, handoff {}".format(
+                strategy, mode, n / duration, stats['fps'], stats['latency'] * 1e3,
+                stats['latency_max'] * 1e3, cam.libc.frames_lost, cam.ring.dropped, cam.handoff_stats))
@@ -13,6 +13,7 @@ but I'm not even sure this is useful at all
 # not to default of 8.
 
 import ctypes
+import ctypes.wintypes
 
 # PCO Constants
 PCO_NOERROR = int("0x00000000",0)
@@ -0,0 +1,166 @@
+""" This file defines the StreamRecorder class, a thread that writes the live frames
+of a PCOEdge (acquired by record_live) to disk, for long acquisitions at camera rate.
+
+The frames are written in a .npy file whose header is rewritten with the number of
+frames at every chunk, so the file can be opened at any time (even during the
+recording) with np.load(path, mmap_mode='r'). A sidecar text file (path + '.index.csv')
+gives for each frame its sequence number, timestamp, exposure time and maximum.
+
+Memory is bounded: the frames are read from the camera ring directly into one
+preallocated chunk of chunk_frames frames, which is written with a single call.
+If the disk is too slow, the ring overwrites frames which are counted in
+stats['dropped'] (back-pressure never blocks the acquisition).
+"""
+
+import sys
+import time
+import threading
+from threading import Thread
+from queue import Empty
+import numpy as np
+
+HEADER_SIZE = 128  # bytes reserved for the .npy header, enough for any 3D shape
+
+
+def npy_header(shape, dtype, size=HEADER_SIZE):
+    """ .npy (version 1.0) header of exactly size bytes (a multiple of 64)"""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %s, }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), repr(tuple(shape)))
+    header = header.ljust(size - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+
+class StreamRecorder(Thread):
+    """
+    Thread writing the frames of a live acquisition to path (.npy).
+
+    Parameters
+    ----------
+    cam : PCOEdge
+        camera in live acquisition (record_live). In the 'copy' handoff mode the
+        recorder reads the ring with its own reader, in 'pool' mode it acquires and
+        releases the frames itself
+    path : str
+        output file, '.npy' is added if needed
+    max_frames : int or None
+        stops after this number of frames (None: until stop() is called)
+    chunk_frames : int
+        number of frames written at once
+    preallocate : bool
+        if max_frames is given, the file is extended to its final size at the start
+    """
+    def __init__(self, cam, path, max_frames=None, chunk_frames=16, preallocate=True):
+        Thread.__init__(self, daemon=True)
+        self._stop_event = threading.Event()
+        self.cam = cam
+        if not path.endswith('.npy'):
+            path += '.npy'
+        self.path = path
+        self.index_path = path + '.index.csv'
+        self.max_frames = max_frames
+        self.chunk_frames = chunk_frames
+        self.preallocate = preallocate
+
+        if cam.handoff_mode == 'copy':
+            self.reader = cam.ring.reader()
+            self.shape, self.dtype = cam.ring.shape, cam.ring.dtype
+        else:
+            self.reader = None
+            self.shape, self.dtype = (cam.wYResAct.value, cam.wXResAct.value), np.dtype(np.uint16)
+        self.chunk = np.empty((chunk_frames,) + self.shape, dtype=self.dtype)
+        self.stats = {'written': 0, 'dropped': 0, 'max_pending': 0, 'write_time': 0.,
+                      'MB/s': 0., 'fps': 0.}
+
+    def _read(self, out):
+        """ reads the next frame in out, returns (seq, frame_max, timestamp)"""
+        if self.reader is not None:
+            frame, seq, frame_max, timestamp = self.reader.get(timeout=0.1, out=out)
+            self.stats['dropped'] = self.reader.dropped
+            self.stats['max_pending'] = max(self.stats['max_pending'], self.reader.pending())
+        else:
+            frame, seq, frame_max, timestamp = self.cam.acquire_frame(timeout=0.1)
+            np.copyto(out, frame)
+            self.cam.release_frame(seq)
+        return seq, frame_max, timestamp
+
+    def _write_chunk(self, f, index, n, rows):
+        t0 = time.perf_counter()
+        f.write(self.chunk[:n].data)  # no copy
+        written = self.stats['written'] + n
+        # rewrite the header with the new number of frames
+        end = f.tell()
+        f.seek(0)
+        f.write(npy_header((written,) + self.shape, self.dtype))
+        f.seek(end)
+        f.flush()
+        index.write(''.join(rows))
+        index.flush()
+        self.stats['write_time'] += time.perf_counter() - t0
+        self.stats['written'] = written
+
+    def run(self):
+        frame_bytes = self.chunk[0].nbytes
+        t_start = time.perf_counter()
+        with open(self.path, 'wb') as f, open(self.index_path, 'w') as index:
+            f.write(npy_header((0,) + self.shape, self.dtype))
+            if self.preallocate and self.max_frames is not None:
+                f.truncate(HEADER_SIZE + self.max_frames * frame_bytes)
+            index.write('frame,seq,timestamp_s,exposure_ms,max\n')
+            n, rows = 0, []
+            while not self._stop_event.is_set():
+                if self.max_frames is not None and self.stats['written'] + n >= self.max_frames:
+                    break
+                try:
+                    seq, frame_max, timestamp = self._read(self.chunk[n])
+                except Empty:
+                    continue
+                rows.append('{:d},{:d},{:.6f},{},{:d}\n'.format(
+                    self.stats['written'] + n, seq, timestamp, self.cam.exposure_ms, int(frame_max)))
+                n += 1
+                if n == self.chunk_frames:
+                    self._write_chunk(f, index, n, rows)
+                    n, rows = 0, []
+                    elapsed = time.perf_counter() - t_start
+                    self.stats['fps'] = self.stats['written'] / elapsed
+                    self.stats['MB/s'] = self.stats['written'] * frame_bytes / 1e6 / max(
+                        self.stats['write_time'], 1e-9)
+            if n > 0:
+                self._write_chunk(f, index, n, rows)
+            f.truncate(HEADER_SIZE + self.stats['written'] * frame_bytes)
+        print("recording done:", self.stats)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+if __name__ == '__main__':
+    # Records frames from the camera without the GUI:
+    # python stream_recorder.py path n_frames [exposure_ms] [--simulate]
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    path, n_frames = args[0], int(args[1])
+    exposure_ms = int(args[2]) if len(args) > 2 else 10
+    if '--simulate' in sys.argv:
+        from pco_simulator import SimulatedPCOEdge
+        cam = SimulatedPCOEdge()
+    else:
+        from pco_definitions import PCOEdge
+        cam = PCOEdge()
+    if cam.open_camera() != 0:
+        sys.exit(1)
+    cam.set_exposure_time(exposure_ms)
+    cam.ring_capacity = 32  # margin for the disk latency
+    cam.arm_camera()
+    cam.allocate_buffer()
+    cam.start_recording()
+    cam._prepare_to_record_to_memory(grab_bool=True)
+    recorder = StreamRecorder(cam, path, max_frames=n_frames)
+    acquisition = Thread(target=cam.record_live, daemon=True)
+    acquisition.start()
+    recorder.start()
+    recorder.join()
+    cam.live = False
+    acquisition.join()
+    cam.disarm_camera()
+    cam.close_camera()
+    data = np.load(recorder.path, mmap_mode='r')
+    print(data.shape, "frames in", recorder.path)